@@ -15,8 +15,13 @@ import os
 import logging
 import tempfile
 import subprocess
+import shutil
 import pathlib
-from collections import defaultdict
+import threading
+import concurrent.futures
+import collections
+import functools
+import selectors
 
 
 if sys.version_info[0] != 3:
@@ -30,13 +35,42 @@ _SUPPORTED_SCHEMES = ('https', 'file')
 ERR_USAGE = 1
 ERR_BUNDLE_FAIL = 2
 FILESYSTEM_DIR_BASENAME = '_filesystem'
-_GIT_ENV = {'GIT_TERMINAL_PROMPT': '0'}
+_GIT_ENV = {
+    'GIT_TERMINAL_PROMPT': '0',
+    # abort transfers slower than 1000 bytes/second for 60 seconds instead of hanging
+    'GIT_HTTP_LOW_SPEED_LIMIT': '1000',
+    'GIT_HTTP_LOW_SPEED_TIME': '60',
+}
+# configuration applied to clones, fetches and ls-remote so that pack indexing and fetches use all cores
+_GIT_TRANSFER_CONFIG = (
+    ('pack.threads', '0'),
+    ('index.threads', '0'),
+    ('fetch.parallel', '0'),
+    ('submodule.fetchJobs', '0'),
+)
 _GIT_VERSION_MAJOR_MIN = 2
 _GIT_VERSION_MINOR_MIN = 3
 _GIT_VERSION_MIN = (_GIT_VERSION_MAJOR_MIN, _GIT_VERSION_MINOR_MIN)
+_GIT_VERSION_RE = re.compile(rb'^git version (\d+)\.(\d+)(?:\.(\d+))?')
 _ENV_THROTTLE_DELAY = 'BUNDLE_REPOS_THROTTLE'
 _DEFAULT_THROTTLER_DELAY_SECONDS = 1.0
+_DEFAULT_JOBS = min(32, (os.cpu_count() or 1) * 2)
+_STDERR_TAIL_CHUNK_SIZE = 64 * 1024
+_STDERR_TAIL_CHUNKS = 16  # at most 1 MiB of stderr is retained with capture='tail'
+_MIN_BACKOFF_SECONDS = 5.0
+# how git and the common hosts report that a client is making requests too frequently
+_RATE_LIMITED_RE = re.compile(rb'returned error: 429|too many requests|rate limit', re.IGNORECASE)
+_CLOSE_FDS_UNNECESSARY = sys.platform.startswith('linux')
+# schemes are case-insensitive (RFC 3986); no other part of the pattern contains letters
+_URL_RE = re.compile(r'^(' + '|'.join(_SUPPORTED_SCHEMES) + r')://(?:([^@/?#]*)@)?([^/?#]*)(/[^?#]*)(?:[?#].*)?$', re.IGNORECASE)
 _GIT_CMD_PRINT_LATEST_COMMIT = ('git', 'for-each-ref', '--count', '1', '--sort=-committerdate', 'refs/heads/')
+_GIT_CMD_PRINT_HEADS = ('git', 'for-each-ref', '--format=%(objectname) %(refname)', 'refs/heads/')
+_HEADS_REF_PREFIX = 'refs/heads/'
+_LS_REMOTE_TIMEOUT_SECONDS = 60
+_NO_TEMPLATE = '--template='  # skip copying sample hooks and other template files into each new repository
+# HEAD is included so that clones of the bundle have something to check out
+_DEFAULT_BUNDLE_REFS = ('--branches', '--tags', 'HEAD')
+_BUNDLE_SIGNATURES = (b'# v2 git bundle\n', b'# v3 git bundle\n')
 
 
 class BundleConfig(object):
@@ -44,7 +78,19 @@ class BundleConfig(object):
     def __init__(self, **kwargs):
         # set defaults and then apply kwargs
         self.ignore_rev = False
-        self.throttler = Throttler(_DEFAULT_THROTTLER_DELAY_SECONDS)
+        self.throttler = None if 'throttler' in kwargs else Throttler(_DEFAULT_THROTTLER_DELAY_SECONDS)
+        self.jobs = _DEFAULT_JOBS
+        self.per_host_jobs = 1
+        self.cache_dir = None
+        self.clone_filter = None
+        self.shallow_depth = None
+        self.extra_git_config = []  # (name, value) pairs applied to clones and fetches after the defaults
+        self.bundle_refs = list(_DEFAULT_BUNDLE_REFS)  # rev-list arguments for git bundle create
+        self.max_consecutive_failures = 5  # stop after this many failures in a row; 0 means never stop
+        self.max_increments = 0  # incremental bundles to write beside a base bundle before rewriting it
+        self.max_retries = 2  # times to retry a clone or fetch that the remote refused because of rate limiting
+        self.transfer_timeout = None  # seconds after which a clone or fetch is killed; None means no limit
+        self.bundle_timeout = None  # seconds after which `git bundle create` is killed; None means no limit
         for k in kwargs:
             getattr(self, k)  # make sure attribute default has been defined
             setattr(self, k, kwargs[k])
@@ -66,45 +112,69 @@ class GitExitCodeException(GitExecutionException):
 class GitVersionException(GitExecutionException):
     
     def __init__(self, version):
-        super(GitVersionException, self).__init__("git version >= {} is required; actual version is {}", _GIT_VERSION_MIN, version), 
+        super(GitVersionException, self).__init__("git version >= {} is required; actual version is {}".format(
+            '.'.join(str(n) for n in _GIT_VERSION_MIN), '.'.join(str(n) for n in version)))
 
 
 def check_no_file_separator_chars(parts):
     for p in parts:
         if '/' in p:
             raise ValueError("URL path must not contain / character (escaped as %2F)")
+        if p in ('.', '..') or '\0' in p:
+            # would let the bundle path escape its place in the bundles tree
+            raise ValueError("URL path must not contain . or .. segments or NUL characters")
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_repository_url(url):
+    """Parses and validates a repository URL into the attribute values of a Repository.
+       The result is cached because the same URLs are parsed repeatedly."""
+    m = _URL_RE.match(url)  # scheme://[userinfo@]netloc/path[?query][#fragment]
+    if m is None:
+        raise ValueError("not a URL with a supported scheme ({}): {}".format(', '.join(_SUPPORTED_SCHEMES), url))
+    scheme, userinfo, netloc, path = m.groups()
+    scheme = scheme.lower()
+    if ':' in netloc.rsplit(']', 1)[-1]:
+        # port not supported here for now; make_bundle_path naming convention would have to be adjusted
+        raise ValueError("port not supported: {}".format(url))
+    if scheme == 'file':
+        host = FILESYSTEM_DIR_BASENAME
+    elif netloc:
+        host = netloc.strip('[]').lower()
+    else:
+        raise ValueError("host is required if scheme is not 'file': {}".format(url))
+    path_parts = [p for p in path.split('/') if p]
+    if len(path_parts) < 2:
+        raise ValueError("URL path must have a prefix and a repository name: {}".format(url))
+    # paths are percent-decoded only; '+' means space in query strings, not in paths (RFC 3986)
+    decoded_path_prefix_parts = [urllib.parse.unquote(p, errors='strict') for p in path_parts[:-1]]
+    decoded_path_prefix = '/'.join(decoded_path_prefix_parts)
+    check_no_file_separator_chars(decoded_path_prefix_parts)
+    path_prefix = '/'.join(path_parts[:-1])
+    repo_name = path_parts[-1]
+    decoded_repo_name = urllib.parse.unquote(repo_name, errors='strict')
+    check_no_file_separator_chars((decoded_repo_name,))
+    username = (userinfo.split(':', 1)[0] if userinfo else None) or _DEFAULT_USERNAME
+    # git looks up the transport by the scheme as written, so it is passed in lowercase
+    repository_argument = urllib.parse.unquote(path) if scheme == 'file' else scheme + url[len(scheme):]
+    path_stem = os.path.join(host, decoded_path_prefix, decoded_repo_name)
+    return scheme, host, path_prefix, repo_name, username, path, decoded_path_prefix, decoded_repo_name, repository_argument, path_stem
 
 
 class Repository(object):
 
     """Class that represents a git repository."""
 
+    __slots__ = ('url', 'scheme', 'host', 'path_prefix', 'repo_name', 'username', '_path', '_decoded_path_prefix', '_decoded_repo_name', '_repository_argument', '_path_stem')
+
     def __init__(self, url):
         self.url = url
-        result = urllib.parse.urlparse(url) # scheme://netloc/path;parameters?query#fragment
-        self.scheme = result.scheme
-        assert self.scheme in _SUPPORTED_SCHEMES, "not a supported scheme: {} (in {})".format(repr(result.scheme), url)
-        assert result.port is None   # port not supported here for now; make_bundle_path naming convention would have to be adjusted
-        self.host = '_filesystem' if result.scheme == 'file' else result.hostname
-        assert self.scheme == 'file' or (self.host is not None and self.host != ''), "host is required if scheme is not 'file'"
-        path_parts = list(filter(lambda p: p != '', result.path.split('/')))
-        decoded_path_prefix_parts = [urllib.parse.unquote_plus(p, errors='strict') for p in path_parts[:-1]]
-        self._decoded_path_prefix = '/'.join(decoded_path_prefix_parts)
-        check_no_file_separator_chars(decoded_path_prefix_parts)
-        self.path_prefix = '/'.join(path_parts[:-1])
-        self.repo_name = path_parts[-1]
-        self._decoded_repo_name = urllib.parse.unquote_plus(self.repo_name, errors='strict')
-        check_no_file_separator_chars((self._decoded_repo_name,))
-        self.username = result.username or _DEFAULT_USERNAME
-        assert self.path_prefix
+        (self.scheme, self.host, self.path_prefix, self.repo_name, self.username, self._path, self._decoded_path_prefix,
+         self._decoded_repo_name, self._repository_argument, self._path_stem) = _parse_repository_url(url)
     
     def get_repository_argument(self):
         """Gets the string to be used as the `git clone` argument."""
-        if self.scheme == 'file':
-            parsed = urllib.parse.urlparse(self.url)
-            return urllib.parse.unquote_plus(parsed.path)
-        else:
-            return self.url
+        return self._repository_argument
     
     def decoded_path_prefix(self):
         return self._decoded_path_prefix
@@ -116,7 +186,20 @@ class Repository(object):
         """Construct the pathname of the bundle that is to represent this repository
            in the filesystem beneath the given parent directory. Note that bundles created
            from source bundles will have a .bundle.bundle suffix."""
-        return os.path.join(parent, self.host, self.decoded_path_prefix(), self.decoded_repo_name() + '.bundle')
+        return os.path.join(parent, self._path_stem + '.bundle')
+
+    def make_cache_path(self, parent):
+        """Construct the pathname of the bare mirror that caches this repository
+           beneath the given parent directory."""
+        return os.path.join(parent, self._path_stem + '.git')
+
+    def dedup_key(self):
+        """Gets a value that is equal for URLs that refer to the same repository, such as
+           URLs that differ only by a .git suffix, a trailing slash, or the case of the host."""
+        name = self._decoded_repo_name
+        if self.scheme != 'file' and name.endswith('.git'):
+            name = name[:-len('.git')]
+        return (self.scheme, self.host, self._decoded_path_prefix, name)
 
     def __str__(self):
         return "Repository{{{}}}".format(self.url)
@@ -127,17 +210,31 @@ class Throttler(object):
     def __init__(self, delay_seconds):
         """Construct an instance with the given delay"""
         self.delay = float(delay_seconds)
-        assert self.delay >= 0, "delay must be >= 0: {}".format(self.delay)
-        self.most_recent = defaultdict(float)
+        if self.delay < 0:
+            raise ValueError("delay must be >= 0: {}".format(self.delay))
+        self._next_ok = {}  # category -> earliest monotonic time at which the next call may proceed
+        self._lock = threading.Lock()
     
     def throttle(self, category=''):
-        last_call = self.most_recent[category]
-        current = time.time()
-        interval = current - last_call
-        if interval < self.delay:
-            self.sleep(self.delay - interval, category)
-        self.most_recent[category] = time.time()
+        """Blocks until at least the delay has elapsed since the previous call in the same category.
+           Concurrent callers in one category are assigned consecutive time slots."""
+        if not self.delay and category not in self._next_ok:
+            return  # nothing to wait for unless a backoff has been made in this category
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_ok.get(category, 0.0))
+            self._next_ok[category] = start + self.delay
+        if start > now:
+            self.sleep(start - now, category)
     
+    def backoff(self, category, attempt):
+        """Blocks for a time that doubles with each attempt after a remote has refused a request
+           because of rate limiting, and holds back other calls in the same category as long."""
+        duration = max(self.delay, _MIN_BACKOFF_SECONDS) * 2 ** attempt
+        with self._lock:
+            self._next_ok[category] = max(self._next_ok.get(category, 0.0), time.monotonic() + duration)
+        self.sleep(duration, category)
+
     def sleep(self, duration, category):
         _log.debug("category=%s; sleeping for %s", category, duration)
         time.sleep(duration)
@@ -147,17 +244,78 @@ class Throttler(object):
         return Throttler(0.0)
 
 
+def _read_tail(fd, tail, deadline=None):
+    """Reads from a pipe until end of file, appending each chunk to tail. Raises
+       subprocess.TimeoutExpired if the time.monotonic() deadline passes first."""
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        while True:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not selector.select(remaining):
+                    raise subprocess.TimeoutExpired(None, None)
+            chunk = os.read(fd, _STDERR_TAIL_CHUNK_SIZE)
+            if not chunk:
+                return
+            tail.append(chunk)
+
+
 class GitRunner(object):
 
     """Shortcut for invoking subprocess.run"""
 
-    def __init__(self, executable, env=_GIT_ENV):
-        self.executable = executable
+    def __init__(self, executable, env=_GIT_ENV, transfer_config=_GIT_TRANSFER_CONFIG):
+        # subprocess can only use posix_spawn instead of fork+exec if the executable is a pathname
+        self.executable = shutil.which(executable) or executable
         self.env = env
-
-    def run(self, cmd, **kwargs):
+        self.transfer_config = tuple(transfer_config)
+        self._transfer_prefix = ['git']
+        for name, value in self.transfer_config:
+            self._transfer_prefix += ['-c', '{}={}'.format(name, value)]
+
+    def _transfer_cmd(self, args):
+        """Builds a command for a git subcommand that transfers objects, applying the transfer configuration."""
+        return self._transfer_prefix + list(args)
+
+    def run(self, cmd, capture='full', **kwargs):
+        """Runs a command. With capture='full', stdout and stderr are captured in full; with
+           capture='tail', stdout is discarded and only the tail of stderr is kept, which bounds
+           memory use for chatty commands like `git clone`; with capture='none', both are discarded.
+           If a timeout is given and expires, the process is killed and subprocess.TimeoutExpired is raised."""
         _log.debug("executing %s", cmd)
-        return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, executable=self.executable, env=self.env, **kwargs)
+        kwargs.setdefault('stdin', subprocess.DEVNULL)
+        if _CLOSE_FDS_UNNECESSARY:
+            # descriptors are non-inheritable by default (PEP 446), so there is nothing to close, and
+            # keeping close_fds=False lets subprocess use posix_spawn for calls without a cwd
+            kwargs.setdefault('close_fds', False)
+        if kwargs.get('cwd') is not None and cmd and cmd[0] == 'git':
+            # subprocess falls back to fork+exec when given a cwd; git can change directory itself
+            cmd = ['git', '-C', str(kwargs.pop('cwd'))] + list(cmd[1:])
+        if capture == 'full':
+            return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, executable=self.executable, env=self.env, **kwargs)
+        if capture == 'none':
+            return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, executable=self.executable, env=self.env, **kwargs)
+        if capture == 'tail':
+            return self._run_tail(cmd, **kwargs)
+        raise ValueError("unsupported capture mode: {}".format(capture))
+
+    def _run_tail(self, cmd, timeout=None, **kwargs):
+        tail = collections.deque(maxlen=_STDERR_TAIL_CHUNKS)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, executable=self.executable, env=self.env, **kwargs) as proc:
+            try:
+                _read_tail(proc.stderr.fileno(), tail, deadline)
+                returncode = proc.wait(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                if proc.poll() is None:
+                    # git stays in our process group so that Ctrl-C reaches it, and only git itself is killed;
+                    # its helpers (e.g. git-remote-https) inherit stderr and may hold it open long after, so
+                    # the pipe is abandoned rather than read to the end, and they exit on finding git gone
+                    proc.kill()
+                    proc.wait()
+                    raise subprocess.TimeoutExpired(proc.args, timeout, stderr=b''.join(tail))
+                returncode = proc.returncode  # git exited, but a helper it left behind still holds stderr
+        return subprocess.CompletedProcess(proc.args, returncode, None, b''.join(tail))
 
     def run_clean(self, cmd, **kwargs):
         proc = self.run(cmd, **kwargs)
@@ -169,24 +327,39 @@ class GitRunner(object):
             _log.error("exit code %s for %s:\n%s\n", proc.returncode, proc.args, proc.stderr)
             raise GitExitCodeException(proc)
 
-    def _clone_mirrored(self, repo_arg, clone_dest_dir, clean):
-        os.makedirs(clone_dest_dir, exist_ok=True)
-        clone_dest_git_dir = os.path.join(clone_dest_dir, '.git')
-        clone_proc = self.run(['git', 'clone', '--mirror', repo_arg, clone_dest_git_dir])
-        if clean:
-            self._check_clean(clone_proc)
-        elif clone_proc.returncode != 0:
-            return clone_proc
-        config_proc = self.run(['git', 'config', '--bool', 'core.bare', 'false'], cwd=clone_dest_dir)
-        if clean:
-            self._check_clean(config_proc)
-        return clone_proc
-
-    def clone_mirrored(self, repo_arg, clone_dest_dir):
-        return self._clone_mirrored(repo_arg, clone_dest_dir, False)
+    def clone_mirrored(self, repo_arg, clone_dest_dir, options=(), timeout=None):
+        """Clones a repository as a bare mirror into a directory that is empty or does not exist;
+           options are additional `git clone` arguments."""
+        return self.run(self._transfer_cmd(['clone', _NO_TEMPLATE, '--mirror'] + list(options) + [repo_arg, clone_dest_dir]), capture='tail', timeout=timeout)
 
     def clone_mirrored_clean(self, repo_arg, clone_dest_dir):
-        return self._clone_mirrored(repo_arg, clone_dest_dir, True)
+        proc = self.clone_mirrored(repo_arg, clone_dest_dir)
+        self._check_clean(proc)
+        return proc
+
+    def clone_bare_clean(self, repo_arg, clone_dest_dir):
+        """Clones a repository's branches and tags into a bare repository, raising an exception on failure.
+           This is cheaper than a mirrored clone when only the branch heads need to be inspected."""
+        return self.run_clean(['git', 'clone', _NO_TEMPLATE, '--bare', repo_arg, clone_dest_dir], capture='tail')
+
+    def update_mirror(self, repo_arg, mirror_dir, timeout=None):
+        """Fetches all refs from a remote into a bare mirror repository, or clones the mirror if it
+           does not exist yet. git removes the directory of a clone that fails, and a clone killed
+           for running past the timeout is removed here, so the next call retries the clone."""
+        if not os.path.isdir(mirror_dir):
+            os.makedirs(os.path.dirname(mirror_dir), exist_ok=True)
+            try:
+                return self.clone_mirrored(repo_arg, mirror_dir, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                # git had no chance to clean up; a partial mirror would be fetched into on later runs
+                shutil.rmtree(mirror_dir, ignore_errors=True)
+                raise
+        # --quiet suppresses the line per updated ref, which can run to tens of thousands on a first fetch
+        return self.run(self._transfer_cmd(['fetch', '--quiet', '--prune', 'origin']), capture='tail', cwd=mirror_dir, timeout=timeout)
+
+    def ls_remote_heads(self, repo_arg, timeout=_LS_REMOTE_TIMEOUT_SECONDS):
+        """Lists the branch heads of a remote repository without transferring any objects."""
+        return self.run(self._transfer_cmd(['ls-remote', '--heads', repo_arg]), timeout=timeout)
 
 
 def read_git_latest_commit(clone_dir, git_runner=None):
@@ -195,85 +368,361 @@ def read_git_latest_commit(clone_dir, git_runner=None):
     if proc.returncode != 0:
         _log.error(proc.stderr)
         raise GitExitCodeException(proc)
-    return proc.stdout.decode('utf-8').split()[0]
+    return proc.stdout.split(None, 1)[0].decode('ascii')  # only the object name; ref names need not be UTF-8
 
 
 def read_git_latest_commit_from_bundle(bundle_path, tempdir, git_runner=None):
+    """Reads the latest commit on any branch in a bundle. The bundle is cloned only if
+       its branches point to more than one commit and commit dates must be compared."""
     git_runner = git_runner or GitRunner('git')
+    head_commits = set(read_git_heads_from_bundle(bundle_path).values())
+    if len(head_commits) == 1:
+        return head_commits.pop()
     with tempfile.TemporaryDirectory(dir=tempdir) as bundle_clone_dir:
-        git_runner.clone_mirrored_clean(bundle_path, bundle_clone_dir)
+        git_runner.clone_bare_clean(bundle_path, bundle_clone_dir)
         return read_git_latest_commit(bundle_clone_dir, git_runner)
 
 
+def parse_heads(text):
+    """Parses lines of `<commit> <refname>` into a dict mapping branch ref names to commit hashes."""
+    heads = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1].startswith(_HEADS_REF_PREFIX):
+            heads[parts[1]] = parts[0]
+    return heads
+
+
+def read_git_heads(clone_dir, git_runner=None):
+    git_runner = git_runner or GitRunner('git')
+    proc = git_runner.run_clean(_GIT_CMD_PRINT_HEADS, cwd=clone_dir)
+    return parse_heads(proc.stdout.decode('utf-8'))
+
+
+def is_shallow_repository(mirror_dir):
+    """Checks whether a bare repository is a shallow clone, which git records by writing
+       the commits at the cut to a file named `shallow` in the repository directory."""
+    return os.path.exists(os.path.join(mirror_dir, 'shallow'))
+
+
+def read_bundle_ref_lines(bundle_path):
+    """Reads the `<commit> <refname>` lines from the header of a bundle file, which is what
+       `git bundle list-heads` prints, without launching a git process."""
+    lines = []
+    with open(bundle_path, 'rb') as ifile:
+        if ifile.readline() not in _BUNDLE_SIGNATURES:
+            raise ValueError("not a v2 or v3 git bundle: {}".format(bundle_path))
+        for line in iter(ifile.readline, b''):
+            if line == b'\n':  # blank line separates the header from the packfile
+                return lines
+            if not line.startswith((b'-', b'@')):  # skip prerequisites and v3 capabilities
+                lines.append(line.decode('utf-8').rstrip('\n'))
+    raise ValueError("bundle header is truncated: {}".format(bundle_path))
+
+
+def read_git_heads_from_bundle(bundle_path):
+    """Reads the branch heads recorded in a bundle's header, without cloning the bundle."""
+    return parse_heads('\n'.join(read_bundle_ref_lines(bundle_path)))
+
+
+def list_bundle_increments(bundle_path):
+    """Lists the incremental bundles beside a base bundle, named <bundle_path>.1, <bundle_path>.2,
+       and so on, in the order in which they must be applied."""
+    increments = []
+    while True:
+        increment_path = '{}.{}'.format(bundle_path, len(increments) + 1)
+        if not os.path.exists(increment_path):
+            return increments
+        increments.append(increment_path)
+
+
+def read_git_heads_from_bundle_chain(bundle_path):
+    """Reads the branch heads of a base bundle as updated by its incremental bundles."""
+    heads = read_git_heads_from_bundle(bundle_path)
+    for increment_path in list_bundle_increments(bundle_path):
+        heads.update(read_git_heads_from_bundle(increment_path))
+    return heads
+
+
+class _FailureCounter(object):
+
+    """Counts consecutive failures across threads, and sets an event once a limit is reached."""
+
+    def __init__(self, limit, tripped):
+        self.limit = limit  # 0 means no limit
+        self.tripped = tripped
+        self._consecutive = 0
+        self._lock = threading.Lock()
+
+    def record(self, ok):
+        with self._lock:
+            self._consecutive = 0 if ok else self._consecutive + 1
+            if self.limit and self._consecutive == self.limit:
+                _log.error("%s bundlings in a row failed; skipping remaining repositories", self._consecutive)
+                self.tripped.set()
+
+
 class Bundler(object):
 
     def __init__(self, treetop, tempdir, git='git', config=None):
         self.config = config or BundleConfig()
-        assert isinstance(self.config, BundleConfig), "config must be a BundleConfig instance"
+        if not isinstance(self.config, BundleConfig):
+            raise TypeError("config must be a BundleConfig instance")
+        if not treetop:
+            raise ValueError("treetop must be nonempty string")
         self.treetop = treetop
-        assert treetop, "treetop must be nonempty string"
+        if tempdir is None:
+            # keep clones beside the bundles rather than in a system temp directory that may be small
+            tempdir = os.path.join(treetop, '.tmp')
+            os.makedirs(tempdir, exist_ok=True)
         self.tempdir = tempdir
-        assert tempdir is None or os.path.isdir(tempdir), "not a directory: {}".format(tempdir[:128])
-        self.git_runner = GitRunner(git)
+        if not os.path.isdir(tempdir):
+            raise ValueError("not a directory: {}".format(tempdir[:128]))
+        self.git_runner = GitRunner(git, transfer_config=_GIT_TRANSFER_CONFIG + tuple(self.config.extra_git_config))
 
     def check_bundle_required(self, remote_clone_path, bundle_path, clone_dest_dir_parent):
-        """Checks whether the latest commit on any branch is the same for a repository path and a bundle."""
-        if self.config.ignore_rev or not os.path.exists(bundle_path):
+        """Checks whether any branch head differs between a repository path and a bundle."""
+        if self.config.ignore_rev:
             return True
-        remote_clone_revision = read_git_latest_commit(remote_clone_path, self.git_runner)
-        bundle_revision = read_git_latest_commit_from_bundle(bundle_path, clone_dest_dir_parent, self.git_runner)
-        return bundle_revision != remote_clone_revision
+        try:
+            bundle_heads = read_git_heads_from_bundle_chain(bundle_path)
+        except FileNotFoundError:
+            return True
+        return bundle_heads != read_git_heads(remote_clone_path, self.git_runner)
+
+    def check_remote_matches_bundle(self, repo_arg, bundle_path):
+        """Checks whether every branch head of a remote repository matches an existing bundle,
+           using `git ls-remote`, which transfers no objects. Returns False if the check cannot
+           be made, in which case the repository must be fetched to find out."""
+        if self.config.ignore_rev:
+            return False
+        try:
+            bundle_heads = read_git_heads_from_bundle_chain(bundle_path)  # read first, so a missing bundle costs no request
+            proc = self.git_runner.ls_remote_heads(repo_arg)
+            if proc.returncode != 0:
+                _log.debug("exit code %s from %s: %s", proc.returncode, proc.args, proc.stderr)
+                return False
+            return parse_heads(proc.stdout.decode('utf-8')) == bundle_heads
+        except FileNotFoundError:
+            return False
+        except (subprocess.TimeoutExpired, ValueError) as ex:
+            _log.debug("could not compare remote heads of %s with %s: %s", repo_arg, bundle_path, ex)
+            return False
+
+    def _clone_options(self):
+        """Gets the `git clone` arguments that limit what is transferred, as configured."""
+        options = []
+        if self.config.clone_filter:
+            options += ['--filter', self.config.clone_filter]
+        if self.config.shallow_depth:
+            options += ['--depth', str(self.config.shallow_depth), '--no-single-branch']
+        return options
+
+    def _create_bundle(self, clone_dest_dir, bundle_path):
+        return self._run_bundle_create(clone_dest_dir, bundle_path, self._bundle_refs(clone_dest_dir))
+
+    def _bundle_refs(self, clone_dest_dir):
+        """Gets the configured rev-list arguments for `git bundle create`, without HEAD if HEAD
+           does not resolve, as when a remote's HEAD names a branch that does not exist; git
+           refuses to create a bundle from a HEAD like that."""
+        refs = list(self.config.bundle_refs)
+        if 'HEAD' in refs:
+            proc = self.git_runner.run(['git', 'rev-parse', '--verify', '--quiet', 'HEAD'], capture='none', cwd=clone_dest_dir)
+            if proc.returncode != 0:
+                _log.debug("HEAD does not resolve in %s; bundling without it", clone_dest_dir)
+                refs.remove('HEAD')
+        return refs
+
+    def _run_bundle_create(self, clone_dest_dir, bundle_path, rev_args):
+        """Runs `git bundle create`. If it is killed for running past config.bundle_timeout, the
+           lock file that git had no chance to remove is removed, or later attempts would be refused."""
+        cmd = ['git', 'bundle', 'create', bundle_path] + list(rev_args)
+        try:
+            return self.git_runner.run(cmd, capture='tail', cwd=clone_dest_dir, timeout=self.config.bundle_timeout)
+        except subprocess.TimeoutExpired:
+            try:
+                os.remove(bundle_path + '.lock')
+            except FileNotFoundError:
+                pass
+            raise
 
     def bundle(self, repo):
+        """Creates or updates the bundle of a repository. Returns the bundle pathname, or None
+           if bundling failed or a clone, fetch or bundle command ran past its configured timeout."""
+        try:
+            return self._bundle(repo)
+        except subprocess.TimeoutExpired as ex:
+            _log.error("bundling %s failed because %s did not finish within %s seconds", repo, ex.cmd, ex.timeout)
+            return None
+
+    def _bundle(self, repo):
         _log.debug("bundling %s to %s", repo, self.treetop)
-        with tempfile.TemporaryDirectory(prefix='clone-dest-parent', dir=self.tempdir) as clone_dest_dir_parent:
-            clone_dest_dir = tempfile.mkdtemp(prefix='clone-dest', dir=clone_dest_dir_parent)
-            repo_arg = repo.get_repository_argument()
-            proc = self.git_runner.clone_mirrored(repo_arg, clone_dest_dir)
+        repo_arg = repo.get_repository_argument()
+        bundle_path = repo.make_bundle_path(self.treetop)
+        if self.check_remote_matches_bundle(repo_arg, bundle_path):
+            _log.info("skipped bundling %s because remote heads match existing bundle at %s", repo, bundle_path)
+            return bundle_path
+        if self.config.cache_dir is not None:
+            repo_dir = repo.make_cache_path(self.config.cache_dir)
+            proc = self._fetch_retrying(repo, lambda: self.git_runner.update_mirror(repo_arg, repo_dir, self.config.transfer_timeout))
+            return self._bundle_fetched(repo, proc, repo_dir, bundle_path)
+        # a scratch directory is needed only when there is no cached mirror to fetch into
+        with tempfile.TemporaryDirectory(prefix='bundle-', dir=self.tempdir) as work_dir:
+            clone_options = self._clone_options()
+            repo_dir = os.path.join(work_dir, 'mirror.git')
+            proc = self._fetch_retrying(repo, lambda: self.git_runner.clone_mirrored(repo_arg, repo_dir, clone_options, self.config.transfer_timeout))
+            return self._bundle_fetched(repo, proc, repo_dir, bundle_path, clone_options)
+
+    def _fetch_retrying(self, repo, fetch):
+        """Runs a clone or fetch, retrying it with backoff for as long as the remote reports
+           rate limiting, up to config.max_retries times. Returns the last process result."""
+        proc = fetch()
+        attempt = 0
+        while proc.returncode != 0 and attempt < self.config.max_retries and _RATE_LIMITED_RE.search(proc.stderr or b''):
+            _log.warning("%s is rate limiting requests; retrying %s (%s of %s)", repo.host, repo, attempt + 1, self.config.max_retries)
+            self.config.throttler.backoff(repo.host, attempt)
+            attempt += 1
+            proc = fetch()
+        return proc
+
+    def _bundle_fetched(self, repo, fetch_proc, repo_dir, bundle_path, clone_options=()):
+        """Creates or updates a bundle, if required, from a repository that was just cloned or
+           fetched into repo_dir. A clone made with clone_options is replaced by a full clone,
+           beside repo_dir, if bundling fails."""
+        if fetch_proc.returncode != 0:
+            _log.error("exit code %s indicates failure to fetch %s using command %s", fetch_proc.returncode, repo, fetch_proc.args)
+            _log.error(fetch_proc.stderr)
+            return None
+        if not self.check_bundle_required(repo_dir, bundle_path, repo_dir):
+            _log.info("skipped bundling %s because synchronized bundle already exists at %s", repo, bundle_path)
+            return bundle_path
+        if clone_options and is_shallow_repository(repo_dir):
+            # git bundles a shallow clone without complaint, but the bundle lacks the commits
+            # beyond the cut, so it cannot be cloned; the shallow clone served only to detect changes
+            _log.info("cloning %s in full because a shallow clone cannot be bundled", repo)
+            repo_dir, proc = self._clone_full(repo, repo_dir)
             if proc.returncode != 0:
-                _log.error("exit code %s indicates failure to clone %s using command %s", proc.returncode, repo, proc.args)
+                _log.error("exit code %s indicates failure to fetch %s using command %s", proc.returncode, repo, proc.args)
                 _log.error(proc.stderr)
                 return None
-            bundle_path = repo.make_bundle_path(self.treetop)
-            if self.check_bundle_required(clone_dest_dir, bundle_path, clone_dest_dir_parent):
-                bundle_dir = os.path.dirname(bundle_path)
-                os.makedirs(bundle_dir, exist_ok=True)
-                proc = self.git_runner.run(['git', 'bundle', 'create', bundle_path, '--all'], cwd=clone_dest_dir)
-                if proc.returncode != 0:
-                    _log.error("bundling %s as %s (from %s) failed: %s", clone_dest_dir, bundle_path, repo, proc)
-                    return None
-                _log.info("bundled %s as %s", repo, bundle_path)
-            else:
-                _log.info("skipped bundling %s because synchronized bundle already exists at %s", repo, bundle_path)
+            clone_options = ()
+        os.makedirs(os.path.dirname(bundle_path), exist_ok=True)
+        increment_path = self._create_incremental_bundle(repo_dir, bundle_path)
+        if increment_path is not None:
+            _log.info("bundled %s as increment %s", repo, increment_path)
             return bundle_path
-
-    def bundle_all(self, repo_urls):
+        # git writes the bundle to <bundle_path>.lock and renames it into place on success
+        proc = self._create_bundle(repo_dir, bundle_path)
+        if proc.returncode != 0 and clone_options:
+            # partial clones lack objects that bundling may need
+            _log.warning("bundling %s from clone with options %s failed; retrying with full clone", repo, clone_options)
+            repo_dir, proc = self._clone_full(repo, repo_dir)
+            if proc.returncode == 0:
+                proc = self._create_bundle(repo_dir, bundle_path)
+        if proc.returncode != 0:
+            _log.error("bundling %s as %s (from %s) failed: %s", repo_dir, bundle_path, repo, proc)
+            return None
+        for increment_path in list_bundle_increments(bundle_path):
+            os.remove(increment_path)  # superseded by the new base bundle
+        _log.info("bundled %s as %s", repo, bundle_path)
+        return bundle_path
+
+    def _clone_full(self, repo, repo_dir):
+        """Clones a repository without the configured clone options, beside repo_dir.
+           Returns the new clone directory and the process result."""
+        full_clone_dir = os.path.join(os.path.dirname(repo_dir), 'full-clone.git')
+        return full_clone_dir, self.git_runner.clone_mirrored(repo.get_repository_argument(), full_clone_dir, timeout=self.config.transfer_timeout)
+
+    def _create_incremental_bundle(self, clone_dest_dir, bundle_path):
+        """Creates a bundle holding only the objects that are not already in a base bundle and its
+           increments. Returns None if there is no base bundle or the increment limit is reached."""
+        if self.config.max_increments < 1 or not os.path.exists(bundle_path):
+            return None
+        increments = list_bundle_increments(bundle_path)
+        if len(increments) >= self.config.max_increments:
+            return None
+        bundled_commits = sorted(set(read_git_heads_from_bundle_chain(bundle_path).values()))
+        increment_path = '{}.{}'.format(bundle_path, len(increments) + 1)
+        proc = self._run_bundle_create(clone_dest_dir, increment_path, self._bundle_refs(clone_dest_dir) + ['^' + c for c in bundled_commits])
+        if proc.returncode != 0:
+            # for example, a bundled commit was force-pushed away, or nothing is new but a branch deletion
+            _log.info("incremental bundle %s not created (exit code %s); rewriting base bundle", increment_path, proc.returncode)
+            return None
+        return increment_path
+
+    def _bundle_host_group(self, host, repos, cancelled, failures):
+        """Bundles repositories taken from a queue of one host's repositories, one at a time,
+           applying the throttle before each remote one. Several workers may share the queue."""
         num_ok = 0
-        repos = list(map(lambda url: Repository(url), repo_urls)) # fail fast if any repos are invalid
-        for repo in repos:
-            self.config.throttler.throttle(repo.host)
-            if self.bundle(repo):
+        while not cancelled.is_set():
+            try:
+                repo = repos.popleft()
+            except IndexError:
+                break
+            if repo.scheme != 'file':  # local repositories need no politeness delay
+                self.config.throttler.throttle(host)
+            ok = bool(self.bundle(repo))
+            failures.record(ok)
+            if ok:
                 num_ok += 1
         return num_ok
 
-
+    def bundle_all(self, repo_urls):
+        """Bundles each repository. Repositories are grouped by host; each host's repositories
+           are bundled by up to config.per_host_jobs workers, throttled, and up to config.jobs
+           workers run at once in total. With the default of one worker per host, no host
+           receives concurrent requests. URLs that refer to a repository already seen are
+           skipped. If an exception is raised, repositories not yet started are skipped and
+           the exception propagates once the bundlings in progress have finished. Repositories
+           not yet started are also skipped once config.max_consecutive_failures bundlings in
+           a row, on any hosts, have failed. Repository instances may be given in place of URLs."""
+        host_groups = collections.OrderedDict()
+        for repo in unique_repositories(repo_urls):  # fail fast if any repos are invalid
+            host_groups.setdefault(repo.host, collections.deque()).append(repo)
+        if not host_groups:
+            return 0
+        cancelled = threading.Event()
+        failures = _FailureCounter(self.config.max_consecutive_failures, cancelled)
+        # start the largest groups first so that a long group does not begin after the pool is otherwise idle
+        ordered_groups = sorted(host_groups.items(), key=lambda item: len(item[1]), reverse=True)
+        tasks = []
+        for host, repos in ordered_groups:
+            tasks += [(host, repos)] * min(self.config.per_host_jobs, len(repos))
+        max_workers = min(self.config.jobs, len(tasks))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._bundle_host_group, host, repos, cancelled, failures) for host, repos in tasks]
+            try:
+                return sum(future.result() for future in concurrent.futures.as_completed(futures))
+            except BaseException:
+                cancelled.set()
+                for future in futures:
+                    future.cancel()
+                raise
+
+
+@functools.lru_cache(maxsize=1)
 def read_git_version():
-    """Execute `git --version` and return a tuple of ints representing the version"""
+    """Execute `git --version` and return a tuple of ints representing the version.
+       The result is cached; call read_git_version.cache_clear() if git changes."""
     proc = GitRunner('git').run(['git', '--version'])
     if proc.returncode != 0:
         _log.error(proc.stderr)
         raise GitExitCodeException(proc);
-    text = proc.stdout.decode('utf-8', 'strict').strip()
-    m = re.match(r'^git version (\d+)\.(\d+)(?:\.(\d+))?.*$', text)
+    return parse_git_version(proc.stdout)
+
+
+def parse_git_version(output):
+    """Parses the bytes printed by `git --version` into a tuple of ints"""
+    m = _GIT_VERSION_RE.match(output)
     if m is None:
-        raise ValueError("unexpected stdout from git --version: {}".format(text[:64]));
-    return tuple(map(int, filter(lambda n: n is not None, m.groups())))
+        raise ValueError("unexpected stdout from git --version: {}".format(output[:64].decode('utf-8', 'replace')))
+    return tuple(int(n) for n in m.groups() if n is not None)
 
 
 def check_git_version(git_version):
     """Check that the version of git that is available meets our minimum requirements (>=2.3)."""
-    assert isinstance(git_version, tuple), "git_version must be a tuple of ints"
-    assert len(tuple(filter(lambda n: 1 if isinstance(n, int) else 0, git_version))) == len(git_version), "all tuple values must be ints"
+    if not all(isinstance(n, int) for n in git_version):
+        raise ValueError("all git_version values must be ints: {}".format(git_version))
     major = git_version[0]
     if major < _GIT_VERSION_MAJOR_MIN:
         raise GitVersionException(git_version)
@@ -283,14 +732,24 @@ def check_git_version(git_version):
             raise GitVersionException(git_version)
 
 
-def clean_index_urls(urls):
-    urls = filter(lambda url: len(url.strip()) > 0, urls) # ignore blank lines
-    urls = filter(lambda url: not url.lstrip().startswith('#'), urls)
-    return list(urls)
+def unique_repositories(urls):
+    """Yields a Repository for each URL, skipping URLs that refer to the same repository as an earlier URL.
+       Repository instances may be given in place of URLs and are yielded as they are."""
+    seen = set()
+    for url in urls:
+        repo = url if isinstance(url, Repository) else Repository(url)
+        key = repo.dedup_key()
+        if key in seen:
+            _log.debug("ignoring duplicate repository url %s", repo.url)
+            continue
+        seen.add(key)
+        yield repo
 
 
-def get_lines(text):
-    return re.split(r'[\n\r]+', text)
+def clean_index_urls(urls):
+    """Returns the stripped URLs from an iterable of lines, skipping blank lines and comments."""
+    stripped = (url.strip() for url in urls)
+    return [url for url in stripped if url and not url.startswith('#')]
 
 
 def main(argv=None): 
@@ -301,6 +760,16 @@ def main(argv=None):
     parser.add_argument('-l', '--log-level', choices=('DEBUG', 'INFO', 'WARN', 'ERROR'), default='INFO', help="set log level", metavar='LEVEL')
     parser.add_argument('--temp-dir', metavar='DIRNAME', help="set temp directory")
     parser.add_argument('--bundles-dir', default=DEFAULT_BUNDLES_DIR, metavar='DIRNAME', help="set bundles tree top directory")
+    parser.add_argument('--cache-dir', metavar='DIRNAME', help="keep mirrors of repositories in this directory and fetch only new objects on subsequent runs")
+    parser.add_argument('--filter', dest='clone_filter', metavar='FILTERSPEC', help="pass --filter=FILTERSPEC to git clone, e.g. blob:none (ignored with --cache-dir)")
+    parser.add_argument('--depth', type=int, metavar='N', help="detect changes with shallow clones of N commits; changed repositories are cloned again in full, because a shallow clone cannot be bundled (ignored with --cache-dir)")
+    parser.add_argument('-c', '--git-config', action='append', default=[], metavar='NAME=VALUE', help="set git configuration for clones, fetches and ls-remote, e.g. protocol.version=2 or http.version=HTTP/2; may be repeated")
+    parser.add_argument('--all-refs', default=False, action='store_true', help="bundle every ref, e.g. refs/pull/* on GitHub mirrors, instead of only branches and tags")
+    parser.add_argument('--incremental', type=int, default=0, metavar='N', help="write up to N incremental bundles beside each existing bundle before rewriting it in full")
+    parser.add_argument('--max-failures', type=int, default=5, metavar='N', help="stop after N bundlings in a row fail, e.g. because the network is down; 0 means never stop (default 5)")
+    parser.add_argument('--retries', type=int, default=2, metavar='N', help="retry a clone or fetch up to N times, backing off exponentially, when the host reports rate limiting (default 2)")
+    parser.add_argument('--clone-timeout', type=float, metavar='SECONDS', help="kill a clone or fetch that runs longer than SECONDS and count the repository as failed (default no limit)")
+    parser.add_argument('--bundle-timeout', type=float, metavar='SECONDS', help="kill a git bundle create that runs longer than SECONDS and count the repository as failed (default no limit)")
     parser.add_argument('--ignore-rev', default=False, action='store_true', help="force bundle creation whether or not existing bundle already has the latest commit")
     default_throttle_delay = os.getenv(_ENV_THROTTLE_DELAY, str(_DEFAULT_THROTTLER_DELAY_SECONDS))
     try:
@@ -309,22 +778,34 @@ def main(argv=None):
         _log.error("could not parse value of {} environment variable {}".format(_ENV_THROTTLE_DELAY, default_throttle_delay[:32]))
         return ERR_USAGE
     parser.add_argument('--delay', default=default_throttle_delay, type=float, help="set per-host throttling delay (or use " + _ENV_THROTTLE_DELAY + " environment variable)", metavar='SECONDS')
+    parser.add_argument('-j', '--jobs', default=_DEFAULT_JOBS, type=int, help="set max number of repositories to bundle concurrently (default {})".format(_DEFAULT_JOBS), metavar='N')
+    parser.add_argument('--per-host-jobs', default=1, type=int, help="set max number of repositories on the same host to bundle concurrently (default 1)", metavar='N')
     args = parser.parse_args(argv)
+    if args.jobs < 1 or args.per_host_jobs < 1:
+        _log.error("jobs and per-host jobs must be >= 1: %s, %s", args.jobs, args.per_host_jobs)
+        return ERR_USAGE
     logging.basicConfig(level=logging.__dict__[args.log_level])
+    extra_git_config = [tuple(item.split('=', 1)) for item in args.git_config]
+    if any(len(item) != 2 for item in extra_git_config):
+        _log.error("git configuration must be specified as NAME=VALUE")
+        return ERR_USAGE
     check_git_version(read_git_version())
-    with open(args.indexfile, 'rb') as ifile:
-        urls = get_lines(ifile.read().decode('utf-8', 'strict'))
-    urls = clean_index_urls(urls)
-    _log.debug("%s repository urls in %s", len(urls), args.indexfile)
-    if len(urls) == 0:
+    with open(args.indexfile, 'r', encoding='utf-8') as ifile:
+        urls = clean_index_urls(ifile)  # iterates over lines without reading the whole file at once
+    num_listed = len(urls)
+    repos = list(unique_repositories(urls))
+    _log.debug("%s repository urls in %s (%s duplicates removed)", len(repos), args.indexfile, num_listed - len(repos))
+    if len(repos) == 0:
         _log.error("index does not contain any repository URLs")
         return 1
-    config = BundleConfig(ignore_rev=args.ignore_rev)
+    config = BundleConfig(ignore_rev=args.ignore_rev, jobs=args.jobs, per_host_jobs=args.per_host_jobs, cache_dir=args.cache_dir, clone_filter=args.clone_filter, shallow_depth=args.depth, extra_git_config=extra_git_config, max_increments=args.incremental, max_consecutive_failures=args.max_failures, max_retries=args.retries, transfer_timeout=args.clone_timeout, bundle_timeout=args.bundle_timeout)
+    if args.all_refs:
+        config.bundle_refs = ['--all']
     bundler = Bundler(args.bundles_dir, args.temp_dir, 'git', config)
-    num_ok = bundler.bundle_all(urls)
+    num_ok = bundler.bundle_all(repos)  # already parsed, so bundle_all does not parse the URLs again
     if num_ok == 0:
-        _log.error("no bundlings succeeded out of %s urls", len(urls))
+        _log.error("no bundlings succeeded out of %s urls", len(repos))
         return ERR_BUNDLE_FAIL
-    if num_ok < len(urls):
-        _log.warn("only %s of %s bundlings succeeded", num_ok, len(urls))
+    if num_ok < len(repos):
+        _log.warn("only %s of %s bundlings succeeded", num_ok, len(repos))
     return 0
@@ -3,15 +3,15 @@
 import unittest
 import bundle_repos
 import sys
+import os
 import tests
-import tests.test_bundle_repos
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
     import logging
     parser = ArgumentParser()
     parser.add_argument("-l", "--log-level", choices=('DEBUG', 'INFO', 'WARN', 'ERROR'))
-    parser.add_argument("-x", "--no-external", action="store_true", help="skip tests that touch external dependencies (e.g. github.com)")
+    parser.add_argument("-e", "--external", action="store_true", help="also run tests that touch external dependencies (e.g. github.com), which are skipped by default")
     args = parser.parse_args()
     if args.log_level:
         stderr_handler = logging.StreamHandler()
@@ -19,7 +19,6 @@ if __name__ == '__main__':
             logger = logging.getLogger(logger_name)
             logger.addHandler(stderr_handler)
             logger.setLevel(logging.__dict__[args.log_level])
-    uargv = sys.argv[0:1]
-    if args.no_external:
-        uargv += [tests.test_bundle_repos.__name__]
-    unittest.main(argv=uargv, module=None)
+    if args.external:
+        os.environ['BUNDLE_REPOS_TESTS_EXTERNAL'] = '1'
+    unittest.main(argv=sys.argv[0:1], module=None)
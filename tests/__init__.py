@@ -6,21 +6,30 @@ import tempfile
 import bundle_repos
 import hashlib
 import shutil
-
-if sys.version_info[0] != 3:
-    sys.stderr.write("requires Python 3\n")
-    sys.exit(1)
+import atexit
+import functools
+import pathlib
+import stat
+import subprocess
 
 def list_files_recursively(dirpath):
+    """Returns a list of the pathnames of files beneath a directory, not following symlinks."""
     all_files = []
-    for root, dirs, files in os.walk(dirpath): # pylint: disable=unused-variable
-        all_files += [os.path.join(root, f) for f in files]
+    stack = [dirpath]
+    while stack:
+        for entry in os.scandir(stack.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            else:
+                all_files.append(entry.path)
     return all_files
 
+_TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'testdata')
+
+@functools.lru_cache(maxsize=None)
 def get_data_dir(relative_path=None):
     """Gets the pathname of the test data directory or an absolute path beneath the test data directory."""
-    parent = os.path.dirname(os.path.dirname(__file__))
-    test_data_dir = os.path.join(parent, 'testdata')
+    test_data_dir = _TEST_DATA_DIR
     assert os.path.isdir(test_data_dir)
     if relative_path is None:
         return test_data_dir
@@ -28,15 +37,57 @@ def get_data_dir(relative_path=None):
     assert os.path.exists(filepath), "not found: {}".format(filepath)
     return filepath
 
+
+@functools.lru_cache(maxsize=None)
+def get_data_uri(relative_path):
+    """Gets the file: URI of a file beneath the test data directory."""
+    return pathlib.PurePath(get_data_dir(relative_path)).as_uri()
+
 def hash_file(pathname):
     """Returns a byte string that is the SHA-256 hash of the file at the given pathname."""
-    h = hashlib.sha256()
     with open(pathname, 'rb') as ifile:
-        h.update(ifile.read())
-    return h.digest()
+        if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+            return hashlib.file_digest(ifile, 'sha256').digest()
+        h = hashlib.sha256()
+        for chunk in iter(functools.partial(ifile.read, 1024 * 1024), b''):
+            h.update(chunk)
+        return h.digest()
+
+def _get_temp_parent():
+    """Gets the directory in which test temporary directories are created: the memory-backed /dev/shm,
+       where available, unless TMPDIR is set explicitly; otherwise the default temporary directory."""
+    shm = '/dev/shm'
+    if 'TMPDIR' not in os.environ and os.path.isdir(shm) and os.access(shm, os.W_OK | os.X_OK):
+        return shm
+    return None
+
+_TEMP_PARENT = _get_temp_parent()
 
 def TemporaryDirectory():
-    return tempfile.TemporaryDirectory(prefix='bundle-repos-tests-')
+    return tempfile.TemporaryDirectory(prefix='bundle-repos-tests-', dir=_TEMP_PARENT)
+
+_empty_repo_dir = None
+
+def get_empty_repo_dir():
+    """Gets the pathname of an empty bare repository, created once per test run. `git bundle verify`
+       must run inside a repository, and it does not modify the repository, so one is enough."""
+    global _empty_repo_dir
+    if _empty_repo_dir is None:
+        tempdir = TemporaryDirectory()
+        atexit.register(tempdir.cleanup)
+        bundle_repos.GitRunner('git').run_clean(['git', 'init', '--bare', '--quiet'], cwd=tempdir.name)
+        _empty_repo_dir = tempdir.name
+    return _empty_repo_dir
+
+@functools.lru_cache(maxsize=None)
+def get_data_clone(relative_path):
+    """Gets the pathname of a bare mirror of a bundle beneath the test data directory, cloned once
+       per test run. Callers must not modify the clone."""
+    tempdir = TemporaryDirectory()
+    atexit.register(tempdir.cleanup)
+    clone_dir = os.path.join(tempdir.name, 'clone.git')
+    bundle_repos.GitRunner('git').clone_mirrored_clean(get_data_dir(relative_path), clone_dir)
+    return clone_dir
 
 class TestGetDataDir(unittest.TestCase):
 
@@ -56,27 +107,57 @@ class EnhancedTestCase(unittest.TestCase):
 
     def assertIsFile(self, pathname, min_size=0):
         assert isinstance(pathname, str)
-        self.assertTrue(os.path.isfile(pathname), "expect file to exist at " + pathname)
-        sz = os.path.getsize(pathname)
-        self.assertGreaterEqual(sz, min_size, "file size is too small")
+        try:
+            st = os.stat(pathname)
+        except FileNotFoundError:
+            st = None
+        self.assertTrue(st is not None and stat.S_ISREG(st.st_mode), "expect file to exist at " + pathname)
+        self.assertGreaterEqual(st.st_size, min_size, "file size is too small")
+
+    def assertBundleHeader(self, bundle_path):
+        """Checks in-process that a file starts with a git bundle signature, without running git."""
+        self.assertIsFile(bundle_path, 1)
+        with open(bundle_path, 'rb') as ifile:
+            signature = ifile.readline()
+        self.assertIn(signature, bundle_repos._BUNDLE_SIGNATURES, "not a git bundle: " + bundle_path)
 
     def assertBundleVerifies(self, bundle_path):
         self.assertIsFile(bundle_path, 1)
         bundle_copy_path = os.path.join(tempfile.gettempdir(), 'git_bundle_for_verification.bundle')
-        shutil.copyfile(bundle_path, bundle_copy_path)
+        try:
+            os.remove(bundle_copy_path)
+        except FileNotFoundError:
+            pass
+        try:
+            os.link(bundle_path, bundle_copy_path)  # no data copied if on the same filesystem
+        except OSError:
+            shutil.copyfile(bundle_path, bundle_copy_path)
         print("bundle copied to", bundle_copy_path)
-        with TemporaryDirectory() as tmpdir:
-            git_runner = bundle_repos.GitRunner('git')
-            proc = git_runner.run(['git', 'init'], cwd=tmpdir) # must run `git bundle verify` inside a repo directory
-            self.assertEqual(proc.returncode, 0, "git init return code nonzero")    
-            proc = git_runner.run(['git', 'bundle', 'verify', bundle_path], cwd=tmpdir)
+        proc = bundle_repos.GitRunner('git').run(['git', 'bundle', 'verify', bundle_path], cwd=get_empty_repo_dir())
+        if proc.returncode != 0:
+            print("bundle verification failed on {}".format(bundle_path), file=sys.stderr)
+            stdout_decoded = proc.stdout.decode('utf-8')
+            stderr_decoded = proc.stderr.decode('utf-8')
+            print("stdout:")
+            print(stdout_decoded)
+            print("stderr:")
+            print(stderr_decoded)
+            sys.stdout.flush()
+        self.assertEqual(proc.returncode, 0, "git bundle return code nonzero")
+
+    def assertBundlesVerify(self, bundle_paths):
+        """Verifies several bundles, running the git bundle verify processes concurrently."""
+        for bundle_path in bundle_paths:
+            self.assertIsFile(bundle_path, 1)
+        procs = [(bundle_path, subprocess.Popen(['git', 'bundle', 'verify', bundle_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=get_empty_repo_dir()))
+                 for bundle_path in bundle_paths]
+        failures = []
+        for bundle_path, proc in procs:
+            stdout, stderr = proc.communicate()
             if proc.returncode != 0:
                 print("bundle verification failed on {}".format(bundle_path), file=sys.stderr)
-                stdout_decoded = proc.stdout.decode('utf-8')
-                stderr_decoded = proc.stderr.decode('utf-8')
-                print("stdout:")
-                print(stdout_decoded)
                 print("stderr:")
-                print(stderr_decoded)
-                sys.stdout.flush()
-            self.assertEqual(proc.returncode, 0, "git bundle return code nonzero")
\ No newline at end of file
+                print(stderr.decode('utf-8'))
+                failures.append(bundle_path)
+        sys.stdout.flush()
+        self.assertEqual(failures, [], "git bundle return code nonzero")
\ No newline at end of file
@@ -18,9 +18,12 @@ import tests
 import re
 import pathlib
 import shutil
+import threading
+import time
 
 KNOWN_SAMPLE_REPO_LATEST_COMMIT_HASH = '930e77627aa807266746f2795b59b890cba70499'
 KNOWN_SAMPLE_REPO_BRANCHED_LATEST_COMMIT_HASH = 'bace9af693b7e502f8c40ca1bf9e281f00498004'
+SHA1_HEX_RE = re.compile(r'^[a-f0-9]{40}')
 
 class TestRepository(unittest.TestCase):
 
@@ -44,6 +47,31 @@ class TestRepository(unittest.TestCase):
         self.assertEqual(r.decoded_path_prefix(), 'Username With Spaces')
         self.assertEqual(r.decoded_repo_name(), 'good@example.com.git')
 
+    def test_plus_in_path(self):
+        r = Repository('https://example.com/c%2B%2B+stuff/g++.git')
+        self.assertEqual(r.decoded_path_prefix(), 'c+++stuff')
+        self.assertEqual(r.decoded_repo_name(), 'g++.git')
+        filepath = '/path/to/c++/hello.git.bundle'
+        self.assertEqual(Repository(pathlib.Path(filepath).as_uri()).get_repository_argument(), filepath)
+
+    def test_good_username_and_query(self):
+        url = 'https://someone@GitHub.com/mike10004/test-child-repo-1.git/?foo=bar#baz'
+        r = Repository(url)
+        self.assertEqual(r.username, 'someone')
+        self.assertEqual(r.host, 'github.com')
+        self.assertEqual(r.path_prefix, 'mike10004')
+        self.assertEqual(r.repo_name, 'test-child-repo-1.git')
+
+    def test_good_uppercase_scheme(self):
+        url = 'HTTPS://GitHub.com/mike10004/test-child-repo-1.git'
+        r = Repository(url)
+        self.assertEqual(r.url, url)
+        self.assertEqual(r.scheme, 'https')
+        self.assertEqual(r.host, 'github.com')
+        self.assertEqual(r.get_repository_argument(), 'https://GitHub.com/mike10004/test-child-repo-1.git')
+        self.assertEqual(r.dedup_key(), Repository('https://github.com/mike10004/test-child-repo-1').dedup_key())
+        self.assertEqual(Repository('FILE:///path/to/hello.git.bundle').get_repository_argument(), '/path/to/hello.git.bundle')
+
     def test_good_without_dot_git_suffix(self):
         url = 'https://somewhere.else/users/mike10004/test-child-repo-1'
         r = Repository(url)
@@ -56,7 +84,7 @@ class TestRepository(unittest.TestCase):
     
     def test_bad_bundle_file(self):
         filepath = '/home/josephine/Developer/bundles/my-project.bundle'
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(ValueError):
             Repository(filepath) # because you must make the path a URI 
 
     def test_good_bundle_file(self):
@@ -82,28 +110,52 @@ class TestRepository(unittest.TestCase):
         self.assertEqual(r.decoded_repo_name(), 'my-project.bundle')
 
     def test_bad(self):
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(ValueError):
             Repository('https://github.com:443/foo/bar.git')
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(ValueError):
             Repository('https://github.com:58671/foo/bar.git')
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(ValueError):
             Repository('http://github.com/foo/bar.git')
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(ValueError):
             Repository('git+ssh://git@github.com/foo/bar.git')
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(ValueError):
             Repository('https://github.com/bar.git')
+        with self.assertRaises(ValueError):
+            Repository('https:///foo/bar.git')
 
     def test_bad_url_has_separator_chars(self):
         with self.assertRaises(ValueError):
             Repository('https://unconscionable.com/User%2Fname/project.git')
         with self.assertRaises(ValueError):
             Repository('https://unconscionable.com/Username/My%2FProject.git')
+        for url in ['https://unconscionable.com/../../etc/passwd', 'https://unconscionable.com/foo/%2E%2E', 'https://unconscionable.com/foo/./bar.git', 'https://unconscionable.com/foo/bar%00.git']:
+            with self.assertRaises(ValueError):
+                Repository(url)
 
     def test_decoded_path_prefix(self):
         url = 'https://somewhere.else/hello%40world/test-child-repo-1.git'
         r = Repository(url)
         self.assertEqual(r.decoded_path_prefix(), "hello@world")
     
+    def test_dedup_key(self):
+        r = Repository('https://github.com/octocat/Hello-World.git')
+        self.assertEqual(r.dedup_key(), Repository('https://GitHub.com/octocat/Hello-World/').dedup_key())
+        self.assertEqual(r.dedup_key(), Repository('https://github.com/octocat/Hello-World').dedup_key())
+        self.assertNotEqual(r.dedup_key(), Repository('https://github.com/octocat/hello-world').dedup_key())
+
+    def test_unique_repositories(self):
+        urls = [
+            'https://github.com/octocat/Hello-World.git',
+            'https://github.com/Microsoft/api-guidelines',
+            'https://github.com/octocat/Hello-World/',
+            'https://github.com/Microsoft/api-guidelines',
+        ]
+        actual = [r.url for r in bundle_repos.unique_repositories(urls)]
+        self.assertListEqual(actual, urls[:2])
+        repos = [Repository(url) for url in urls]
+        actual = list(bundle_repos.unique_repositories(repos))
+        self.assertListEqual(actual, repos[:2])
+
     def test_make_bundle_path(self):
         url = 'https://somewhere.else/mpsycho/hello.git'
         r = Repository(url)
@@ -122,59 +174,82 @@ class TestRepository(unittest.TestCase):
 
 GIT_REPLACER_SCRIPT_CONTENT = """#!/bin/bash
     set -e
+    while [ "$1" == "-c" ] || [ "$1" == "-C" ] ; do
+      if [ "$1" == "-C" ] ; then
+        cd "$2"                           # change directory like git does
+      fi
+      shift 2                             # skip configuration options
+    done
     CMD=$1
     if [ "$CMD" == "clone" ] ; then
       echo $0 $@
       CLONE_DEST="${@: -1:1}"             # destination dir is last argument
       mkdir -vp "$CLONE_DEST"
+      if [ -e "$CLONE_DEST.hang" ] ; then
+        sleep 10                          # hang until killed, leaving a partial clone
+      fi
     elif [ "$CMD" == "bundle" ] ; then
       echo $0 $@
-      BUNDLE_PATH="${@: -2:1}"            # bundle pathname is penultimate argument
-      touch "$BUNDLE_PATH"
+      BUNDLE_PATH="$3"                    # bundle pathname follows 'bundle create'
+      if [ -e "$BUNDLE_PATH.lock" ] ; then
+        echo "fatal: Unable to create '$BUNDLE_PATH.lock': File exists." >&2
+        exit 128
+      fi
+      : > "$BUNDLE_PATH.lock"             # write through a lock file like git does
+      if [ -e "$BUNDLE_PATH.hang" ] ; then
+        sleep 10                          # hang until killed, leaving the lock file
+      fi
+      mv "$BUNDLE_PATH.lock" "$BUNDLE_PATH"
+    elif [ "$CMD" == "rev-parse" ] ; then
+      DIGEST=$(sha1sum <<< "$PWD")        # HEAD resolves to the commit that for-each-ref reports
+      echo "${DIGEST%% *}"
     elif [ "$CMD" == "for-each-ref" ] ; then
-      echo -n "$PWD" | sha1sum | cut -f1 -d' '
+      DIGEST=$(sha1sum <<< "$PWD")        # a single process; the fake commit id need not match echo -n
+      echo "${DIGEST%% *}"                # drop the trailing '  -' without another process
     else
       echo $0 $@
       echo "$CMD is not a git command" >&2
       exit 1
     fi
 """
+GIT_REPLACER_SCRIPT_BYTES = GIT_REPLACER_SCRIPT_CONTENT.encode('utf-8')
 
-def create_script_file(content):
+def create_script_file(content_bytes):
     fd, scriptpath = tempfile.mkstemp(".sh", "test_bundle_repos_script")
-    os.write(fd, content.encode('utf-8'))
+    os.write(fd, content_bytes)
     os.close(fd)
     os.chmod(scriptpath, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
     return scriptpath    
 
 class FakeGitUsingTestCase(unittest.TestCase):
 
-    def setUp(self):
-        self.git_script = create_script_file(GIT_REPLACER_SCRIPT_CONTENT)
-        self.git_runner = bundle_repos.GitRunner(self.git_script)
-    
-    def tearDown(self):
+    @classmethod
+    def setUpClass(cls):
+        cls.git_script = create_script_file(GIT_REPLACER_SCRIPT_BYTES)
+
+    @classmethod
+    def tearDownClass(cls):
         try:
-            os.remove(self.git_script)
+            os.remove(cls.git_script)
         except FileNotFoundError as ex:
             print(ex, file=sys.stderr)
 
+    def setUp(self):
+        self.git_runner = bundle_repos.GitRunner(self.git_script)
+
 class FakeGitUsingTestCaseTest(FakeGitUsingTestCase):
 
     def test_git_script_clone(self):
         with tests.TemporaryDirectory() as tempdir:
             clone_dest = os.path.join(tempdir, 'clone-destination')
-            proc = self.git_runner.run(['git', 'clone', 'REMOTE_URL', clone_dest])
-            print(proc.stdout.decode('utf-8'))
-            print(proc.stderr.decode('utf-8'), file=sys.stderr)
+            proc = self.git_runner.run(['git', 'clone', 'REMOTE_URL', clone_dest], capture='none')
             self.assertEqual(proc.returncode, 0)
+            self.assertTrue(os.path.isdir(clone_dest))
     
     def test_git_script_bundle(self):
         with tests.TemporaryDirectory() as tempdir:
             bundle_path = os.path.join(tempdir, 'my.bundle')
-            proc = self.git_runner.run(['git', 'bundle', 'create', bundle_path, "--all"])
-            print(proc.stdout.decode('utf-8'))
-            print(proc.stderr.decode('utf-8'), file=sys.stderr)
+            proc = self.git_runner.run(['git', 'bundle', 'create', bundle_path, "--all"], capture='none')
             self.assertEqual(proc.returncode, 0)
             self.assertTrue(os.path.isfile(bundle_path), "bundle not created: " + bundle_path)
 
@@ -184,7 +259,23 @@ class FakeGitUsingTestCaseTest(FakeGitUsingTestCase):
             os.makedirs(clone_dir)
             proc = self.git_runner.run(bundle_repos._GIT_CMD_PRINT_LATEST_COMMIT, cwd=clone_dir)
             self.assertEqual(proc.returncode, 0)
-            self.assertRegex(proc.stdout.decode('utf-8'), r'^[a-f0-9]{40}')
+            self.assertRegex(proc.stdout.decode('utf-8'), SHA1_HEX_RE)
+
+    def test_git_script_clone_with_config(self):
+        with tests.TemporaryDirectory() as tempdir:
+            clone_dest = os.path.join(tempdir, 'clone-destination')
+            proc = self.git_runner.run(self.git_runner._transfer_cmd(['clone', 'REMOTE_URL', clone_dest]), capture='none')
+            self.assertEqual(proc.returncode, 0)
+            self.assertTrue(os.path.isdir(clone_dest))
+
+    def test_update_mirror_timeout_removes_partial_clone(self):
+        with tests.TemporaryDirectory() as tempdir:
+            mirror_dir = os.path.join(tempdir, 'host', 'mirror.git')
+            os.makedirs(os.path.dirname(mirror_dir))
+            open(mirror_dir + '.hang', 'w').close()  # makes the fake git hang after creating the clone directory
+            with self.assertRaises(subprocess.TimeoutExpired):
+                self.git_runner.update_mirror('REMOTE_URL', mirror_dir, timeout=0.3)
+            self.assertFalse(os.path.exists(mirror_dir), "partial mirror left behind")
 
     def test_git_script_fail(self):
         proc = self.git_runner.run(['git', 'fail', 'yolo'])
@@ -196,13 +287,68 @@ class CountingThrottler(bundle_repos.Throttler):
 
     def __init__(self, category=''):
         super(CountingThrottler, self).__init__(0.0)
-        self.counts = collections.defaultdict(int)
+        self.counts = collections.Counter()
+        self.counts_lock = threading.Lock()
         self.tag = 'COUNTER'
     
     def throttle(self, category):
-        self.counts[category] = self.counts[category] + 1
+        with self.counts_lock:
+            self.counts[category] += 1
         super(CountingThrottler, self).throttle(category)
 
+class SleepRecordingThrottler(bundle_repos.Throttler):
+
+    def __init__(self, delay_seconds):
+        super(SleepRecordingThrottler, self).__init__(delay_seconds)
+        self.sleeps = []
+
+    def sleep(self, duration, category):
+        self.sleeps.append((category, duration))
+
+
+class TestThrottler(unittest.TestCase):
+
+    def test_no_delay(self):
+        throttler = SleepRecordingThrottler(0.0)
+        for _ in range(3):
+            throttler.throttle('a')
+        self.assertListEqual(throttler.sleeps, [])
+        self.assertDictEqual(throttler._next_ok, {})
+
+    def test_negative_delay(self):
+        with self.assertRaises(ValueError):
+            bundle_repos.Throttler(-1)
+
+    def test_throttle(self):
+        throttler = SleepRecordingThrottler(60.0)
+        throttler.throttle('a')
+        throttler.throttle('b')
+        self.assertListEqual(throttler.sleeps, [])
+        throttler.throttle('a')
+        throttler.throttle('a')
+        self.assertListEqual([c for c, _ in throttler.sleeps], ['a', 'a'])
+        first, second = [d for _, d in throttler.sleeps]
+        self.assertGreater(first, 59.0)
+        self.assertGreater(second, 119.0)
+
+    def test_backoff(self):
+        throttler = SleepRecordingThrottler(0.0)
+        throttler.backoff('a', 0)
+        throttler.backoff('a', 2)
+        self.assertListEqual(throttler.sleeps, [('a', 5.0), ('a', 20.0)])
+        throttler.throttle('b')
+        self.assertIn('a', throttler._next_ok)
+        self.assertNotIn('b', throttler._next_ok)
+
+    def test_backoff_holds_back_category_without_delay(self):
+        throttler = SleepRecordingThrottler(0.0)
+        throttler.backoff('a', 0)
+        throttler.throttle('a')
+        throttler.throttle('b')
+        self.assertListEqual([c for c, _ in throttler.sleeps], ['a', 'a'])
+        self.assertGreater(throttler.sleeps[1][1], 4.0)
+
+
 class TestBundle(FakeGitUsingTestCase):
 
     def make_bundler(self, tempdir, config=None):
@@ -216,12 +362,37 @@ class TestBundle(FakeGitUsingTestCase):
             print("created {}".format(bundle_name))
             expected = os.path.join(treetop, 'localhost', 'hsolo', 'falcon.git.bundle')
             self.assertEqual(bundle_name, expected)
-            if not os.path.isfile(bundle_name):
+            bundle_exists = os.path.isfile(bundle_name)
+            if not bundle_exists:
                 print("contents of directory {}".format(treetop), file=sys.stderr)
                 for f in tests.list_files_recursively(treetop):
                     print("  '{}'".format(f), file=sys.stderr)
-            self.assertTrue(os.path.isfile(bundle_name), "expected file to exist at " + bundle_name)
+            self.assertTrue(bundle_exists, "expected file to exist at " + bundle_name)
     
+    def test_bundle_timeout_removes_lock(self):
+        repo = Repository("https://localhost/hsolo/falcon.git")
+        with tests.TemporaryDirectory() as treetop:
+            bundler = self.make_bundler(treetop, bundle_repos.BundleConfig(bundle_timeout=0.5))
+            bundle_path = repo.make_bundle_path(treetop)
+            os.makedirs(os.path.dirname(bundle_path))
+            hang_marker = bundle_path + '.hang'  # makes the fake git hang after creating the lock file
+            open(hang_marker, 'w').close()
+            self.assertIsNone(bundler.bundle(repo))
+            os.remove(hang_marker)
+            self.assertFalse(os.path.exists(bundle_path + '.lock'), "lock file left behind")
+            self.assertEqual(bundler.bundle(repo), bundle_path)
+            self.assertTrue(os.path.isfile(bundle_path))
+
+    def test_bundle_default_tempdir(self):
+        repo = Repository("https://localhost/hsolo/falcon.git")
+        with tests.TemporaryDirectory() as treetop:
+            bundler = bundle_repos.Bundler(treetop, None, git=self.git_script)
+            self.assertEqual(bundler.tempdir, os.path.join(treetop, '.tmp'))
+            bundle_name = bundler.bundle(repo)
+            self.assertEqual(bundle_name, os.path.join(treetop, 'localhost', 'hsolo', 'falcon.git.bundle'))
+            self.assertTrue(os.path.isfile(bundle_name), "expected file to exist at " + bundle_name)
+            self.assertListEqual(os.listdir(bundler.tempdir), [])
+
     def test_bundle_all_throttling(self):
         repo_urls = [
             "https://github.com/octocat/Hello-World.git",
@@ -230,8 +401,7 @@ class TestBundle(FakeGitUsingTestCase):
             "https://github.com/Microsoft/api-guidelines",
         ]
         counter = CountingThrottler(0)
-        config = bundle_repos.BundleConfig()
-        config.throttler = counter
+        config = bundle_repos.BundleConfig(throttler=counter)
         with tests.TemporaryDirectory() as tmpdir:
             self.make_bundler(tmpdir, config).bundle_all(repo_urls)
         print("counts: {}".format(counter.counts))
@@ -239,6 +409,69 @@ class TestBundle(FakeGitUsingTestCase):
         self.assertEqual(counter.counts['bitbucket.org'], 1)
         self.assertEqual(counter.counts['localhost'], 1)
 
+    def test_bundle_all_jobs(self):
+        repo_urls = [
+            "https://github.com/octocat/Hello-World.git",
+            "https://localhost/foo/bar.git",
+            "https://bitbucket.org/atlassian_tutorial/helloworld.git",
+            "https://github.com/Microsoft/api-guidelines",
+        ]
+        for jobs in (1, 4):
+            config = bundle_repos.BundleConfig(jobs=jobs, throttler=bundle_repos.Throttler.no_delay())
+            with tests.TemporaryDirectory() as tmpdir:
+                num_ok = self.make_bundler(tmpdir, config).bundle_all(url for url in repo_urls)
+                self.assertEqual(num_ok, len(repo_urls), "num_ok with jobs={}".format(jobs))
+                self.assertEqual(len(tests.list_files_recursively(tmpdir)), len(repo_urls))
+
+
+    def test_bundle_all_per_host_jobs(self):
+        repo_urls = ["https://github.com/octocat/repo{}.git".format(i) for i in range(5)] + ["https://localhost/foo/bar.git"]
+        for per_host_jobs in (1, 2, 8):
+            counter = CountingThrottler(0)
+            config = bundle_repos.BundleConfig(jobs=4, per_host_jobs=per_host_jobs, throttler=counter)
+            with tests.TemporaryDirectory() as tmpdir:
+                num_ok = self.make_bundler(tmpdir, config).bundle_all(repo_urls)
+                self.assertEqual(num_ok, len(repo_urls), "num_ok with per_host_jobs={}".format(per_host_jobs))
+                self.assertEqual(len(tests.list_files_recursively(tmpdir)), len(repo_urls))
+            self.assertDictEqual(dict(counter.counts), {'github.com': 5, 'localhost': 1})
+
+    def test_bundle_all_invalid_url(self):
+        repo_urls = ["https://localhost/foo/bar.git"] * 8 + ["http://localhost/foo/insecure.git"]
+        config = bundle_repos.BundleConfig(jobs=1, throttler=SleepRecordingThrottler(0.0))
+        with tests.TemporaryDirectory() as tmpdir:
+            with self.assertRaises(ValueError):
+                self.make_bundler(tmpdir, config).bundle_all(repo_urls)
+
+
+class RateLimitedGitRunner(bundle_repos.GitRunner):
+    """Reports rate limiting for the first clone and holds every other clone until a backoff has begun."""
+
+    def __init__(self, backoff_begun):
+        super(RateLimitedGitRunner, self).__init__('git')
+        self.backoff_begun = backoff_begun
+        self.num_clones = 0
+        self.lock = threading.Lock()
+
+    def clone_mirrored(self, repo_arg, clone_dest_dir, options=(), timeout=None):
+        with self.lock:
+            self.num_clones += 1
+            first = self.num_clones == 1
+        if first:
+            return subprocess.CompletedProcess(['git'], 128, None, b'fatal: unable to access: The requested URL returned error: 429\n')
+        self.backoff_begun.wait(10)
+        return subprocess.CompletedProcess(['git'], 128, None, b'fatal: repository not found\n')
+
+
+class BackoffSignallingThrottler(SleepRecordingThrottler):
+
+    def __init__(self, delay_seconds):
+        super(BackoffSignallingThrottler, self).__init__(delay_seconds)
+        self.backoff_begun = threading.Event()
+
+    def backoff(self, category, attempt):
+        super(BackoffSignallingThrottler, self).backoff(category, attempt)
+        self.backoff_begun.set()
+
 
 class TestBundleFail(tests.EnhancedTestCase):
 
@@ -257,10 +490,50 @@ class TestBundleFail(tests.EnhancedTestCase):
                 potential_bundle_path = Repository(url).make_bundle_path(bundles_dir)
                 self.assertFalse(os.path.exists(potential_bundle_path), "file exists at {} but shouldn't".format(potential_bundle_path))
 
+    def test_fetch_retrying(self):
+        rate_limited = subprocess.CompletedProcess(['git'], 128, None, b'fatal: unable to access: The requested URL returned error: 429\n')
+        not_found = subprocess.CompletedProcess(['git'], 128, None, b'fatal: repository not found\n')
+        ok = subprocess.CompletedProcess(['git'], 0, None, b'')
+        repo = Repository("https://localhost/hsolo/falcon.git")
+        for results, expected_num_calls, expected_returncode in [([ok], 1, 0), ([rate_limited, ok], 2, 0), ([not_found, ok], 1, 128), ([rate_limited] * 4, 3, 128)]:
+            with self.subTest(results=[r.stderr for r in results]):
+                throttler = SleepRecordingThrottler(0.0)
+                results_left = list(results)
+                with tests.TemporaryDirectory() as tmpdir:
+                    bundler = bundle_repos.Bundler(tmpdir, tmpdir, config=bundle_repos.BundleConfig(throttler=throttler))
+                    proc = bundler._fetch_retrying(repo, lambda: results_left.pop(0))
+                self.assertEqual(len(results) - len(results_left), expected_num_calls)
+                self.assertEqual(proc.returncode, expected_returncode)
+                self.assertListEqual([c for c, _ in throttler.sleeps], ['localhost'] * (expected_num_calls - 1))
+
+    def test_bundle_all_backoff_holds_back_other_workers(self):
+        repo_urls = ["https://localhost/hsolo/repo{}.git".format(i) for i in range(3)]
+        throttler = BackoffSignallingThrottler(0.0)
+        config = bundle_repos.BundleConfig(jobs=2, per_host_jobs=2, throttler=throttler, max_consecutive_failures=0)
+        with tests.TemporaryDirectory() as tmpdir:
+            bundler = bundle_repos.Bundler(tmpdir, tmpdir, config=config)
+            bundler.git_runner = RateLimitedGitRunner(throttler.backoff_begun)
+            bundler.bundle_all(repo_urls)
+        # one sleep for the backoff, and at least one by whichever worker takes the last repository after it
+        self.assertGreaterEqual(len(throttler.sleeps), 2)
+        self.assertSetEqual({c for c, _ in throttler.sleeps}, {'localhost'})
+
+    def test_bundle_all_stops_after_consecutive_failures(self):
+        repo_urls = ["file:///path/to/nowhere{}.bundle".format(i) for i in range(3)]
+        repo_urls.append(tests.get_data_uri('sample-repo.bundle'))
+        for limit, expected_num_ok in [(3, 0), (4, 1), (0, 1)]:
+            with self.subTest(limit=limit):
+                config = bundle_repos.BundleConfig(max_consecutive_failures=limit)
+                with tests.TemporaryDirectory() as tmpdir:
+                    num_ok = bundle_repos.Bundler(os.path.join(tmpdir, 'bundles'), tmpdir, config=config).bundle_all(repo_urls)
+                self.assertEqual(num_ok, expected_num_ok)
+
 class TestGitVersionTest(unittest.TestCase):
 
     def test_read(self):
+        bundle_repos.read_git_version.cache_clear()
         version = bundle_repos.read_git_version()
+        self.assertIs(bundle_repos.read_git_version(), version)
         self.assertTrue(isinstance(version, tuple))
         self.assertTrue(len(version) >= 2)
         self.assertTrue(isinstance(version[0], int))
@@ -268,15 +541,35 @@ class TestGitVersionTest(unittest.TestCase):
         self.assertGreaterEqual(version[0], 0)
         self.assertGreaterEqual(version[1], 0)
 
+    def test_parse(self):
+        test_cases = [
+            (b'git version 2.39.5\n', (2, 39, 5)),
+            (b'git version 2.3\n', (2, 3)),
+            (b'git version 2.39.5 (Apple Git-154)\n', (2, 39, 5)),
+            (b'git version 2.43.0.windows.1\n', (2, 43, 0)),
+        ]
+        for output, expected in test_cases:
+            with self.subTest(output=output):
+                self.assertEqual(bundle_repos.parse_git_version(output), expected)
+        with self.assertRaises(ValueError):
+            bundle_repos.parse_git_version(b'hub version 2.14.2\n')
+
 class TestCheckGitVersion(unittest.TestCase):
     def test_check_bad(self):
-        for version in [(1, 7, 0), (0, 0, 0), (1, 7), (0, 0), (2, 1), (2, 1, 29)]:
-            with self.assertRaises(bundle_repos.GitVersionException):
-                bundle_repos.check_git_version(version)
+        for version in ((1, 7, 0), (0, 0, 0), (1, 7), (0, 0), (2, 1), (2, 1, 29)):
+            with self.subTest(version=version):
+                with self.assertRaises(bundle_repos.GitVersionException) as cm:
+                    bundle_repos.check_git_version(version)
+                self.assertEqual(str(cm.exception), "git version >= 2.3 is required; actual version is {}".format('.'.join(map(str, version))))
     
     def test_check_good(self):
-        for version in [(2, 3, 0), (2, 3), (2, 3, 9), (2, 11, 0), (2, 11), (3, 0), (3, 0, 0)]:
-            bundle_repos.check_git_version(version)
+        for version in ((2, 3, 0), (2, 3), (2, 3, 9), (2, 11, 0), (2, 11), (3, 0), (3, 0, 0)):
+            with self.subTest(version=version):
+                bundle_repos.check_git_version(version)
+
+    def test_check_not_ints(self):
+        with self.assertRaises(ValueError):
+            bundle_repos.check_git_version(('2', '3'))
 
 class TestGitRunner(unittest.TestCase):
 
@@ -288,13 +581,49 @@ class TestGitRunner(unittest.TestCase):
             actual = proc.stdout.decode('utf8').strip()
             self.assertEqual(actual, tempdir)
     
+    def test_capture(self):
+        runner = bundle_repos.GitRunner('sh')
+        cmd = ['sh', '-c', 'echo out; echo err >&2; exit 3']
+        proc = runner.run(cmd)
+        self.assertEqual((proc.returncode, proc.stdout, proc.stderr), (3, b'out\n', b'err\n'))
+        proc = runner.run(cmd, capture='tail')
+        self.assertEqual((proc.returncode, proc.stdout, proc.stderr), (3, None, b'err\n'))
+        proc = runner.run(cmd, capture='none')
+        self.assertEqual((proc.returncode, proc.stdout, proc.stderr), (3, None, None))
+
+    def test_capture_tail_is_bounded(self):
+        runner = bundle_repos.GitRunner('sh')
+        proc = runner.run(['sh', '-c', 'head -c 4000000 /dev/zero >&2'], capture='tail')
+        self.assertEqual(proc.returncode, 0)
+        self.assertLessEqual(len(proc.stderr), bundle_repos._STDERR_TAIL_CHUNK_SIZE * bundle_repos._STDERR_TAIL_CHUNKS)
+
+    def test_capture_tail_timeout(self):
+        runner = bundle_repos.GitRunner('sh')
+        cmd = ['sh', '-c', 'echo started >&2; exec sleep 30']
+        start = time.monotonic()
+        with self.assertRaises(subprocess.TimeoutExpired) as cm:
+            runner.run(cmd, capture='tail', timeout=0.2)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(cm.exception.stderr, b'started\n')
+        proc = runner.run(['sh', '-c', 'exit 3'], capture='tail', timeout=10)
+        self.assertEqual(proc.returncode, 3)
+
+    def test_capture_tail_timeout_child_holds_stderr(self):
+        runner = bundle_repos.GitRunner('sh')
+        cmd = ['sh', '-c', 'echo started >&2; sleep 10 & wait']  # the background sleep outlives the killed shell
+        start = time.monotonic()
+        with self.assertRaises(subprocess.TimeoutExpired) as cm:
+            runner.run(cmd, capture='tail', timeout=0.5)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(cm.exception.stderr, b'started\n')
+
     def test_clone_mirrored_clean(self):
         bundle_path = tests.get_data_dir('sample-repo-branched.bundle')
         with tests.TemporaryDirectory() as clone_dir:
             runner = bundle_repos.GitRunner('git')
             runner.clone_mirrored_clean(bundle_path, clone_dir)
             branch_list_lines = runner.run_clean(['git', 'branch', '-l'], cwd=clone_dir).stdout.decode('utf-8').split("\n")
-            branch_list_lines = list(filter(lambda x: x, branch_list_lines))
+            branch_list_lines = [line for line in branch_list_lines if line]
             branch_list = [b.strip().split()[-1] for b in branch_list_lines]
             self.assertSetEqual(set(branch_list), {'master', 'other-branch'})
 
@@ -306,10 +635,10 @@ class TestReadGitLatestCommit(unittest.TestCase):
         self.unbranched_bundle_path = tests.get_data_dir('sample-repo.bundle')
 
     def test_read_git_latest_commit(self):
-        self.do_test_read_git_latest_commit(self.unbranched_bundle_path, KNOWN_SAMPLE_REPO_LATEST_COMMIT_HASH)
+        self.do_test_read_git_latest_commit('sample-repo.bundle', KNOWN_SAMPLE_REPO_LATEST_COMMIT_HASH)
 
     def test_read_git_latest_commit_branched(self):
-        self.do_test_read_git_latest_commit(self.branched_bundle_path, KNOWN_SAMPLE_REPO_BRANCHED_LATEST_COMMIT_HASH)
+        self.do_test_read_git_latest_commit('sample-repo-branched.bundle', KNOWN_SAMPLE_REPO_BRANCHED_LATEST_COMMIT_HASH)
 
     def test_read_git_latest_commit_from_bundle(self):
         self.do_test_read_git_latest_commit_from_bundle(self.unbranched_bundle_path, KNOWN_SAMPLE_REPO_LATEST_COMMIT_HASH)
@@ -322,20 +651,46 @@ class TestReadGitLatestCommit(unittest.TestCase):
             commit_hash = bundle_repos.read_git_latest_commit_from_bundle(bundle_path, tempdir)
             self.assertEqual(commit_hash, expected_hash)
 
-    def do_test_read_git_latest_commit(self, bundle_path, expected_hash):
-        with tests.TemporaryDirectory() as tempdir:
-            git = bundle_repos.GitRunner('git')
-            clone_dir = os.path.join(tempdir, 'cloned-bundle-directory')
-            git.clone_mirrored_clean(bundle_path, clone_dir)
-            commit_hash = bundle_repos.read_git_latest_commit(clone_dir)
-            self.assertEqual(commit_hash, expected_hash)
+    def do_test_read_git_latest_commit(self, bundle_name, expected_hash):
+        commit_hash = bundle_repos.read_git_latest_commit(tests.get_data_clone(bundle_name))
+        self.assertEqual(commit_hash, expected_hash)
+
+class TestReadGitHeads(unittest.TestCase):
+
+    def test_read_git_heads_from_bundle(self):
+        heads = bundle_repos.read_git_heads_from_bundle(tests.get_data_dir('sample-repo-branched.bundle'))
+        self.assertSetEqual(set(heads.keys()), {'refs/heads/master', 'refs/heads/other-branch'})
+        self.assertIn(KNOWN_SAMPLE_REPO_BRANCHED_LATEST_COMMIT_HASH, heads.values())
+
+    def test_read_git_heads(self):
+        bundle_path = tests.get_data_dir('sample-repo-branched.bundle')
+        clone_dir = tests.get_data_clone('sample-repo-branched.bundle')
+        self.assertDictEqual(bundle_repos.read_git_heads(clone_dir), bundle_repos.read_git_heads_from_bundle(bundle_path))
+
+    def test_read_bundle_ref_lines(self):
+        bundle_path = tests.get_data_dir('sample-repo-branched.bundle')
+        proc = bundle_repos.GitRunner('git').run_clean(['git', 'bundle', 'list-heads', bundle_path])
+        expected = proc.stdout.decode('utf-8').splitlines()
+        self.assertListEqual(bundle_repos.read_bundle_ref_lines(bundle_path), expected)
+
+    def test_read_bundle_ref_lines_not_bundle(self):
+        with tempfile.NamedTemporaryFile(suffix='.bundle') as ofile:
+            ofile.write(b'this is not a bundle\n')
+            ofile.flush()
+            with self.assertRaises(ValueError):
+                bundle_repos.read_bundle_ref_lines(ofile.name)
+
+    def test_parse_heads(self):
+        text = "930e77627aa807266746f2795b59b890cba70499 refs/heads/master\n930e77627aa807266746f2795b59b890cba70499 HEAD\n"
+        self.assertDictEqual(bundle_repos.parse_heads(text), {'refs/heads/master': KNOWN_SAMPLE_REPO_LATEST_COMMIT_HASH})
+
 
 class TestBundleFromBundleSource(tests.EnhancedTestCase):
 
     def test_bundle_from_bundle_source(self):
         source_bundle_path = tests.get_data_dir('sample-repo.bundle')
         assert os.path.isfile(source_bundle_path)
-        repo = Repository(pathlib.Path(source_bundle_path).as_uri())
+        repo = Repository(tests.get_data_uri('sample-repo.bundle'))
         with tests.TemporaryDirectory() as tmpdir:
             bundler = bundle_repos.Bundler(tmpdir, tmpdir)
             bundle_path = bundler.bundle(repo)
@@ -343,6 +698,107 @@ class TestBundleFromBundleSource(tests.EnhancedTestCase):
             self.assertIsNotNone(bundle_path, "bundle path is None")
             self.assertBundleVerifies(bundle_path)
 
+    def test_bundle_shallow(self):
+        with tests.TemporaryDirectory() as tmpdir:
+            git_runner = bundle_repos.GitRunner('git')
+            work_dir = os.path.join(tmpdir, 'work')
+            git_runner.run_clean(['git', 'clone', '--quiet', tests.get_data_dir('sample-repo-branched.bundle'), work_dir])
+            for i in range(2):
+                git_runner.run_clean(['git', '-c', 'user.name=A', '-c', 'user.email=a@example.com', 'commit', '--quiet', '--allow-empty', '-m', str(i)], cwd=work_dir)
+            repo = Repository(pathlib.Path(work_dir).as_uri())
+            repo._repository_argument = repo.url  # git ignores --depth when cloning from a plain path
+            config = bundle_repos.BundleConfig(shallow_depth=1)
+            bundle_path = bundle_repos.Bundler(os.path.join(tmpdir, 'bundles'), tmpdir, config=config).bundle(repo)
+            self.assertIsNotNone(bundle_path, "bundle path is None")
+            clone_dir = os.path.join(tmpdir, 'restored')
+            proc = git_runner.clone_mirrored(bundle_path, clone_dir)
+            self.assertEqual(proc.returncode, 0, proc.stderr)
+            self.assertDictEqual(bundle_repos.read_git_heads(clone_dir), bundle_repos.read_git_heads(work_dir))
+
+    def test_bundle_refs(self):
+        with tests.TemporaryDirectory() as tmpdir:
+            git_runner = bundle_repos.GitRunner('git')
+            work_dir = os.path.join(tmpdir, 'work')
+            git_runner.run_clean(['git', 'clone', '--quiet', tests.get_data_dir('sample-repo-branched.bundle'), work_dir])
+            git_runner.run_clean(['git', 'update-ref', 'refs/pull/1/head', 'HEAD'], cwd=work_dir)
+            source_bundle_path = os.path.join(tmpdir, 'source.bundle')
+            git_runner.run_clean(['git', 'bundle', 'create', source_bundle_path, '--all'], cwd=work_dir)
+            repo = Repository(pathlib.Path(source_bundle_path).as_uri())
+            for bundle_refs, expect_pull_ref in [(None, False), (['--all'], True)]:
+                with self.subTest(bundle_refs=bundle_refs):
+                    config = bundle_repos.BundleConfig(ignore_rev=True)
+                    if bundle_refs is not None:
+                        config.bundle_refs = bundle_refs
+                    bundle_path = bundle_repos.Bundler(os.path.join(tmpdir, 'bundles'), tmpdir, config=config).bundle(repo)
+                    self.assertIsNotNone(bundle_path, "bundle path is None")
+                    self.assertBundleHeader(bundle_path)
+                    refnames = [line.split(' ', 1)[1] for line in bundle_repos.read_bundle_ref_lines(bundle_path)]
+                    self.assertIn('HEAD', refnames)
+                    self.assertEqual('refs/pull/1/head' in refnames, expect_pull_ref)
+
+
+    def test_bundle_dangling_head(self):
+        with tests.TemporaryDirectory() as tmpdir:
+            git_runner = bundle_repos.GitRunner('git')
+            work_dir = os.path.join(tmpdir, 'work.git')
+            git_runner.run_clean(['git', 'clone', '--quiet', '--mirror', tests.get_data_dir('sample-repo-branched.bundle'), work_dir])
+            git_runner.run_clean(['git', 'symbolic-ref', 'HEAD', 'refs/heads/nonexistent'], cwd=work_dir)
+            repo = Repository(pathlib.Path(work_dir).as_uri())
+            bundle_path = bundle_repos.Bundler(os.path.join(tmpdir, 'bundles'), tmpdir).bundle(repo)
+            self.assertIsNotNone(bundle_path, "bundle path is None")
+            self.assertBundleVerifies(bundle_path)
+            self.assertDictEqual(bundle_repos.read_git_heads_from_bundle(bundle_path), bundle_repos.read_git_heads(work_dir))
+
+    def test_bundle_incremental(self):
+        with tests.TemporaryDirectory() as tmpdir:
+            git_runner = bundle_repos.GitRunner('git')
+            work_dir = os.path.join(tmpdir, 'work')
+            git_runner.run_clean(['git', 'clone', '--quiet', tests.get_data_dir('sample-repo.bundle'), work_dir])
+            source_bundle_path = os.path.join(tmpdir, 'source.bundle')
+            repo = Repository(pathlib.Path(source_bundle_path).as_uri())
+            bundler = bundle_repos.Bundler(os.path.join(tmpdir, 'bundles'), tmpdir, config=bundle_repos.BundleConfig(max_increments=2))
+            bundle_path = repo.make_bundle_path(bundler.treetop)
+            for num_commits in range(4):
+                if num_commits > 0:
+                    git_runner.run_clean(['git', '-c', 'user.name=A', '-c', 'user.email=a@example.com', 'commit', '--quiet', '--allow-empty', '-m', str(num_commits)], cwd=work_dir)
+                git_runner.run_clean(['git', 'bundle', 'create', source_bundle_path, '--all'], cwd=work_dir)
+                self.assertEqual(bundler.bundle(repo), bundle_path)
+                expected_increments = [bundle_path + '.1', bundle_path + '.2'][:num_commits] if num_commits < 3 else []
+                self.assertListEqual(bundle_repos.list_bundle_increments(bundle_path), expected_increments)
+                self.assertDictEqual(bundle_repos.read_git_heads_from_bundle_chain(bundle_path), bundle_repos.read_git_heads(work_dir))
+            self.assertBundleVerifies(bundle_path)
+
+
+    def test_bundle_all_local_not_throttled(self):
+        repo_urls = [tests.get_data_uri(name) for name in ('sample-repo.bundle', 'sample-repo-branched.bundle')]
+        throttler = SleepRecordingThrottler(60.0)
+        config = bundle_repos.BundleConfig(throttler=throttler)
+        with tests.TemporaryDirectory() as tmpdir:
+            num_ok = bundle_repos.Bundler(os.path.join(tmpdir, 'bundles'), tmpdir, config=config).bundle_all(repo_urls)
+        self.assertEqual(num_ok, 2)
+        self.assertListEqual(throttler.sleeps, [])
+        self.assertDictEqual(throttler._next_ok, {})
+
+
+class TestBundleWithCache(tests.EnhancedTestCase):
+
+    def test_bundle_with_cache(self):
+        repo = Repository(tests.get_data_uri('sample-repo-branched.bundle'))
+        with tests.TemporaryDirectory() as tmpdir:
+            cache_dir = os.path.join(tmpdir, 'cache')
+            config = bundle_repos.BundleConfig(cache_dir=cache_dir)
+            bundler = bundle_repos.Bundler(tmpdir, tmpdir, config=config)
+            bundle_path = bundler.bundle(repo)
+            self.assertIsNotNone(bundle_path, "bundle path is None")
+            self.assertBundleVerifies(bundle_path)
+            cache_path = repo.make_cache_path(cache_dir)
+            self.assertTrue(os.path.isdir(cache_path), "expected mirror at " + cache_path)
+            self.assertEqual(bundle_repos.read_git_latest_commit(cache_path), KNOWN_SAMPLE_REPO_BRANCHED_LATEST_COMMIT_HASH)
+            original_metadata = os.stat(bundle_path)
+            self.assertEqual(bundler.bundle(repo), bundle_path)
+            self.assertEqual(os.stat(bundle_path), original_metadata, "file metadata should NOT have changed")
+
+
 class TestBundleConfig(tests.EnhancedTestCase):
 
     def test_kwargs(self):
@@ -357,8 +813,7 @@ class TestBundleConfig(tests.EnhancedTestCase):
 class TestBundleRevisionCheck(tests.EnhancedTestCase):
 
     def test_bundle_required(self):
-        source_bundle_path = tests.get_data_dir('sample-repo-branched.bundle')
-        source_bundle_uri = pathlib.PurePath(source_bundle_path).as_uri()
+        source_bundle_uri = tests.get_data_uri('sample-repo-branched.bundle')
         original_bundle_path = tests.get_data_dir('sample-repo.bundle')
         original_hash = tests.hash_file(original_bundle_path)
         with tests.TemporaryDirectory() as tmpdir:
@@ -380,8 +835,7 @@ class TestBundleRevisionCheck(tests.EnhancedTestCase):
             self.assertNotEqual(new_hash, original_hash, "hash should have changed")
     
     def test_bundle_not_required_skip(self):
-        source_bundle_path = tests.get_data_dir('sample-repo.bundle')
-        source_bundle_uri = pathlib.PurePath(source_bundle_path).as_uri()
+        source_bundle_uri = tests.get_data_uri('sample-repo.bundle')
         original_bundle_path = tests.get_data_dir('sample-repo.bundle')
         original_hash = tests.hash_file(original_bundle_path)
         with tests.TemporaryDirectory() as tmpdir:
@@ -397,9 +851,27 @@ class TestBundleRevisionCheck(tests.EnhancedTestCase):
             new_metadata = os.stat(new_bundle_path)
             self.assertEqual(new_metadata, original_metadata, "file metadata should NOT have changed")
 
-    def test_bundle_not_required_force(self):
+    def test_bundle_not_required_skip_without_fetch(self):
         source_bundle_path = tests.get_data_dir('sample-repo.bundle')
-        source_bundle_uri = pathlib.PurePath(source_bundle_path).as_uri()
+        with tests.TemporaryDirectory() as tmpdir:
+            repo = Repository(tests.get_data_uri('sample-repo.bundle'))
+            dest_bundle_path = repo.make_bundle_path(tmpdir)
+            os.makedirs(os.path.dirname(dest_bundle_path))
+            shutil.copyfile(source_bundle_path, dest_bundle_path)
+            bundler = bundle_repos.Bundler(tmpdir, tmpdir)
+            self.assertTrue(bundler.check_remote_matches_bundle(repo.get_repository_argument(), dest_bundle_path))
+            commands = []
+            run = bundler.git_runner.run
+            def recording_run(cmd, *args, **kwargs):
+                commands.append(cmd)
+                return run(cmd, *args, **kwargs)
+            bundler.git_runner.run = recording_run
+            self.assertEqual(bundler.bundle(repo), dest_bundle_path)
+            self.assertEqual(len(commands), 1)
+            self.assertIn('ls-remote', commands[0])
+
+    def test_bundle_not_required_force(self):
+        source_bundle_uri = tests.get_data_uri('sample-repo.bundle')
         original_bundle_path = tests.get_data_dir('sample-repo.bundle')
         with tests.TemporaryDirectory() as tmpdir:
             repo = Repository(source_bundle_uri)
@@ -416,19 +888,6 @@ class TestBundleRevisionCheck(tests.EnhancedTestCase):
 
 class TestCli(unittest.TestCase):
 
-
-    def test_get_lines(self):
-        test_cases = [
-            ("a\nb\nc\n", ["a", "b", "c", ""]),
-            ("a\nb\nc", ["a", "b", "c"]),
-            ("This is\na string with \r\n all kinds of\n\rline\r\rseparators\n\nmixed together\n\n\ncrazily.", ["This is", "a string with ", " all kinds of", "line", "separators", "mixed together", "crazily."]),
-        ]
-        for text, expected in test_cases:
-            actual = bundle_repos.get_lines(text)
-            self.assertEqual(actual, expected)
-
-
-
     def test_clean_index_urls(self):
         test_cases = [
             {
@@ -443,6 +902,10 @@ class TestCli(unittest.TestCase):
                 'input': ["https://hello.com/world", "#https://foo.bar/baz", "#", "https://what.ever/hella", "#   "],
                 'output': ["https://hello.com/world", "https://what.ever/hella"]
             },
+            {
+                'input': ["https://hello.com/world\n", "  # comment\n", "\n", "  https://foo.bar/baz  \r\n"],
+                'output': ["https://hello.com/world", "https://foo.bar/baz"]
+            },
             {
                 'input': ["# This is a test file", "file:///home/mike/ws/public1/git-multi-bundler/testdata/sample-repo-branched.bundle"],
                 'output': ["file:///home/mike/ws/public1/git-multi-bundler/testdata/sample-repo-branched.bundle"]
@@ -453,8 +916,7 @@ class TestCli(unittest.TestCase):
             self.assertListEqual(output, test_case['output'], 'cleaned output URL list is not what is expected')
     
     def test_main(self):
-        source_bundle_path = tests.get_data_dir('sample-repo-branched.bundle')
-        source_bundle_uri = pathlib.PurePath(source_bundle_path).as_uri()
+        source_bundle_uri = tests.get_data_uri('sample-repo-branched.bundle')
         print("source bundle uri:", source_bundle_uri)
         with tempfile.TemporaryDirectory() as tempdir:
             indexfile = os.path.join(tempdir, 'remote_urls.txt')
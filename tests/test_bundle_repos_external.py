@@ -10,13 +10,10 @@ import unittest
 import os.path
 import bundle_repos
 from bundle_repos import Repository
-import tempfile
 import tests
 import os
 
-_TMP_PREFIX = os.path.join(tempfile.gettempdir(), 'bundle-repos-')
-
-@unittest.skipIf(os.getenv('BUNDLE_REPOS_TESTS_SKIP_EXTERNAL') == '1', "BUNDLE_REPOS_TESTS_SKIP_EXTERNAL=1")
+@unittest.skipUnless(os.getenv('BUNDLE_REPOS_TESTS_EXTERNAL') == '1', "set BUNDLE_REPOS_TESTS_EXTERNAL=1 to run")
 class TestBundleForReal(tests.EnhancedTestCase):
 
     def test_bundle_one(self):
@@ -39,8 +36,7 @@ class TestBundleForReal(tests.EnhancedTestCase):
             "https://github.com/Microsoft/api-guidelines",
         ]
         throttler = bundle_repos.Throttler(2.0)
-        config = bundle_repos.BundleConfig()
-        config.throttler = throttler
+        config = bundle_repos.BundleConfig(throttler=throttler)
         with tests.TemporaryDirectory() as tmpdir:
             bundles_dir = os.path.join(tmpdir, 'repositories')
             os.mkdir(bundles_dir)
@@ -50,10 +46,10 @@ class TestBundleForReal(tests.EnhancedTestCase):
             bundle_files = tests.list_files_recursively(bundles_dir)
             print("bundle files: {}".format(bundle_files))
             self.assertEqual(len(bundle_files), len(repo_urls))
-            self.assertBundleVerifies((os.path.join(bundles_dir, 'github.com', 'octocat', 'Hello-World.git.bundle')))
-            self.assertBundleVerifies((os.path.join(bundles_dir, 'github.com', 'octocat', 'git-consortium.bundle')))
-            self.assertBundleVerifies((os.path.join(bundles_dir, 'github.com', 'Microsoft', 'api-guidelines.bundle')))
-            self.assertBundleVerifies((os.path.join(bundles_dir, 'bitbucket.org', 'atlassian_tutorial', 'helloworld.git.bundle')))
+            self.assertBundlesVerify([os.path.join(bundles_dir, 'github.com', 'octocat', 'Hello-World.git.bundle'),
+                                      os.path.join(bundles_dir, 'github.com', 'octocat', 'git-consortium.bundle'),
+                                      os.path.join(bundles_dir, 'github.com', 'Microsoft', 'api-guidelines.bundle'),
+                                      os.path.join(bundles_dir, 'bitbucket.org', 'atlassian_tutorial', 'helloworld.git.bundle')])
     
     def test_bundle_fail(self):
         """Tests bundling a repository that does not exist, causing a failure"""
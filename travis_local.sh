@@ -10,5 +10,4 @@ fi
 set -e
 PYTHON=python3
 $PYTHON -c 'import sys; assert sys.version_info.major >= 3 and sys.version_info.minor >= 5, "version incompatible: " + sys.version'
-export BUNDLE_REPOS_TESTS_SKIP_EXTERNAL=1
 python3 -m unittest discover